@@ -1,10 +1,23 @@
 import connexion
+from connexion import NoContent, request
 from pykafka import KafkaClient
+from pykafka.common import OffsetType
+from pykafka.exceptions import KafkaException
 import json
 import yaml
+import time
+import random
 import logging.config
 import os
+import queue
+import hashlib
+from collections import OrderedDict
+from functools import wraps
+from threading import Thread, Lock
 from connexion.middleware import MiddlewarePosition
+from common.codec import decode_message
+from common.metrics import KAFKA_CONSUMED, MetricsMiddleware, observe_event_age, start_lag_monitor
+from common.offsets import seek_offset
 from starlette.middleware.cors import CORSMiddleware
 
 # Get environment
@@ -17,25 +30,474 @@ KAFKA_HOST = app_config["kafka"]["events"]["hostname"]
 KAFKA_PORT = app_config["kafka"]["events"]["port"]
 KAFKA_TOPIC = app_config["kafka"]["events"]["topic"]
 
+INDEX_ENABLED = app_config.get("index", {}).get("enabled", False)
+INDEX_SNAPSHOT_FILE = app_config.get("index", {}).get("snapshot_file")
+INDEX_SNAPSHOT_INTERVAL_S = app_config.get("index", {}).get("snapshot_interval_s", 60)
+
+POOL_SIZE = app_config.get("pool", {}).get("size", 4)
+POOL_CONSUMER_TIMEOUT_MS = app_config.get("pool", {}).get("consumer_timeout_ms", 5000)
+
+VALIDATE_RESPONSES = app_config.get("api", {}).get("validate_responses", True)
+
+CACHE_ENABLED = app_config.get("cache", {}).get("enabled", False)
+CACHE_MAX_ENTRIES = app_config.get("cache", {}).get("max_entries", 1024)
+CACHE_MAX_BYTES = app_config.get("cache", {}).get("max_bytes", 16 * 1024 * 1024)
+CACHE_TTL_S = app_config.get("cache", {}).get("ttl_s", 300)
+CACHE_MAX_AGE_S = app_config.get("cache", {}).get("max_age_s", 2)
+
 # Logging
 with open(f"config/log_conf.{ENVIRONMENT}.yml", "r") as f:
     LOG_CONFIG = yaml.safe_load(f.read())
     logging.config.dictConfig(LOG_CONFIG)
 logger = logging.getLogger('basicLogger')
 
+def log_latency(handler):
+    """ Logs how long each call to a request handler takes """
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        start_time = time.time()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            processing_time_ms = int((time.time() - start_time) * 1000)
+            logger.info(f"{handler.__name__} completed | processing_time_ms={processing_time_ms}")
+    return wrapper
+
+class KafkaPool:
+    """
+    Long-lived Kafka client with a pool of reusable consumers. Consumers are
+    positioned by seeking to offsets and stop at the end of each partition
+    instead of waiting for a consumer timeout.
+    """
+    def __init__(self, hostname, topic, size):
+        self.hostname = hostname
+        self.topic = topic
+        self.size = size
+        self.client = None
+        self.lock = Lock()
+        self.created = 0
+        self.consumers = queue.Queue()
+
+    def get_topic(self):
+        """ Returns the topic, making the shared client on first use """
+        with self.lock:
+            while self.client is None:
+                logger.debug("Trying to connect to Kafka...")
+                try:
+                    self.client = KafkaClient(hosts=self.hostname)
+                    logger.info("Kafka client created")
+                except KafkaException as e:
+                    logger.warning(f"Kafka error when making client: {e}")
+                    # Sleeps for a random amount of time (0.5 to 1.5s)
+                    time.sleep(random.randint(500, 1500) / 1000)
+            return self.client.topics[str.encode(self.topic)]
+
+    def borrow(self):
+        """ Takes a consumer from the pool, making one if the pool is not full """
+        try:
+            return self.consumers.get_nowait()
+        except queue.Empty:
+            pass
+        topic = self.get_topic()
+        with self.lock:
+            make_consumer = self.created < self.size
+            if make_consumer:
+                self.created += 1
+        if not make_consumer:
+            return self.consumers.get()
+        logger.debug("Creating pooled Kafka consumer")
+        return topic.get_simple_consumer(consumer_timeout_ms=POOL_CONSUMER_TIMEOUT_MS)
+
+    def release(self, consumer, broken=False):
+        if broken:
+            consumer.stop()
+            with self.lock:
+                self.created -= 1
+                self.client = None
+            return
+        self.consumers.put(consumer)
+
+    def messages(self, start_offsets=None):
+        """
+        Generator of messages from start_offsets (partition ID -> offset,
+        default earliest) up to the high watermark of each partition.
+        """
+        topic = self.get_topic()
+        consumer = self.borrow()
+        broken = False
+        try:
+            earliest = topic.earliest_available_offsets()
+            latest = topic.latest_available_offsets()
+            # Offset of the last message currently in each partition
+            end_offsets = {pid: latest[pid].offset[0] - 1 for pid in latest}
+            start_offsets = start_offsets or {pid: earliest[pid].offset[0] for pid in earliest}
+            remaining = {
+                pid for pid, offset in start_offsets.items()
+                if offset <= end_offsets.get(pid, -1)
+            }
+            if not remaining:
+                return
+            consumer.reset_offsets([
+                (consumer.partitions[pid], seek_offset(start_offsets[pid])) for pid in remaining
+            ])
+            for msg in consumer:
+                if msg.partition_id not in remaining:
+                    continue
+                yield msg
+                if msg.offset >= end_offsets[msg.partition_id]:
+                    remaining.discard(msg.partition_id)
+                    if not remaining:
+                        break
+        except KafkaException as e:
+            logger.warning(f"Kafka issue in pooled consumer: {e}")
+            broken = True
+        finally:
+            self.release(consumer, broken)
+
+    def fetch(self, partition_id, offset):
+        """ Reads the single message at a partition/offset """
+        for msg in self.messages({partition_id: offset}):
+            if msg.offset == offset:
+                return decode_message(msg.value)
+            break
+        return None
+
+kafka_pool = KafkaPool(f"{KAFKA_HOST}:{KAFKA_PORT}", KAFKA_TOPIC, POOL_SIZE)
+
+class EventIndex:
+    """
+    In-memory index of the events topic, kept up to date by a background
+    consumer. Holds per-type counts, the partition/offset of every event by
+    type index and the event IDs, so requests never replay the topic.
+    """
+    def __init__(self, hostname, topic, snapshot_file=None):
+        self.hostname = hostname
+        self.topic = topic
+        self.snapshot_file = snapshot_file
+        self.client = None
+        self.lock = Lock()
+        self.positions = {"chat": [], "donation": []}
+        self.event_ids = {"chat": [], "donation": []}
+        self.offsets = {}
+        self.last_snapshot = time.time()
+        self.restore()
+
+    def restore(self):
+        """ Loads the latest snapshot, if any, so only newer messages are replayed """
+        if self.snapshot_file is None:
+            return
+        try:
+            with open(self.snapshot_file, "r") as fd:
+                data = json.load(fd)
+        except (OSError, ValueError):
+            logger.info("No index snapshot found, replaying topic from the start")
+            return
+        if data.get("topic") != self.topic:
+            logger.warning(f"Ignoring index snapshot of topic {data.get('topic')}")
+            return
+        self.positions = {t: [tuple(p) for p in data["positions"][t]] for t in self.positions}
+        self.event_ids = {t: [tuple(e) for e in data["event_ids"][t]] for t in self.event_ids}
+        self.offsets = {int(pid): offset for pid, offset in data["offsets"].items()}
+        logger.info(f"Restored index snapshot at offsets {self.offsets}")
+
+    def snapshot(self):
+        """ Writes the index to a temp file, then swaps it in """
+        if self.snapshot_file is None:
+            return
+        # Shallow copies are cheap, the index is only locked while they are taken
+        with self.lock:
+            data = {
+                "topic": self.topic,
+                "offsets": dict(self.offsets),
+                "positions": {t: list(p) for t, p in self.positions.items()},
+                "event_ids": {t: list(e) for t, e in self.event_ids.items()},
+            }
+        tmp_file = f"{self.snapshot_file}.tmp"
+        with open(tmp_file, "w") as fd:
+            json.dump(data, fd)
+        os.replace(tmp_file, self.snapshot_file)
+        self.last_snapshot = time.time()
+        logger.debug(f"Wrote index snapshot at offsets {data['offsets']}")
+
+    def connect(self):
+        """Infinite loop: will keep trying"""
+        while True:
+            logger.debug("Trying to connect to Kafka...")
+            try:
+                self.client = KafkaClient(hosts=self.hostname)
+                topic = self.client.topics[str.encode(self.topic)]
+                consumer = topic.get_simple_consumer(
+                    reset_offset_on_start=True,
+                    auto_offset_reset=OffsetType.EARLIEST,
+                    consumer_timeout_ms=1000
+                )
+                with self.lock:
+                    offsets = dict(self.offsets)
+                if offsets:
+                    consumer.reset_offsets([
+                        (consumer.partitions[pid], offset)
+                        for pid, offset in offsets.items()
+                        if pid in consumer.partitions
+                    ])
+                logger.info("Kafka index consumer created")
+                return consumer
+            except KafkaException as e:
+                logger.warning(f"Kafka error when making index consumer: {e}")
+                self.client = None
+            # Sleeps for a random amount of time (0.5 to 1.5s)
+            time.sleep(random.randint(500, 1500) / 1000)
+
+    def add(self, msg):
+        """
+        Folds one consumed message into the index. Everything is read before
+        the lock is taken, so a bad message leaves the index unchanged.
+        Raises KeyError or ValueError for a malformed message.
+        """
+        data = decode_message(msg.value)
+        KAFKA_CONSUMED.labels(self.topic, "analyzer_index").inc()
+        observe_event_age("indexed", data)
+        event_type = data["type"]
+        if event_type in self.positions:
+            payload = data["payload"]
+            ids = (payload["event_id"], payload["trace_id"])
+        with self.lock:
+            self.offsets[msg.partition_id] = msg.offset
+            if event_type not in self.positions:
+                return
+            self.positions[event_type].append((msg.partition_id, msg.offset))
+            self.event_ids[event_type].append(ids)
+
+    def skip(self, msg):
+        """ Moves past a message that can't be indexed """
+        with self.lock:
+            self.offsets[msg.partition_id] = msg.offset
+
+    def run(self):
+        """ Tails the topic forever """
+        consumer = self.connect()
+        while True:
+            try:
+                for msg in consumer:
+                    try:
+                        self.add(msg)
+                    except (KeyError, ValueError) as e:
+                        logger.error(f"Skipping malformed message at partition {msg.partition_id} offset {msg.offset}: {e}")
+                        self.skip(msg)
+                    if time.time() - self.last_snapshot >= INDEX_SNAPSHOT_INTERVAL_S:
+                        self.snapshot()
+            except KafkaException as e:
+                logger.warning(f"Kafka issue in index consumer: {e}")
+                consumer = self.connect()
+                continue
+            # consumer_timeout_ms passed with no new messages
+            if time.time() - self.last_snapshot >= INDEX_SNAPSHOT_INTERVAL_S:
+                self.snapshot()
+
+    def start(self):
+        t1 = Thread(target=self.run)
+        t1.setDaemon(True)
+        t1.start()
+        start_lag_monitor(self.topic, "analyzer_index", self.lag)
+
+    def lag(self):
+        """ Messages left to index per partition, None if the broker can't be reached """
+        try:
+            latest = kafka_pool.get_topic().latest_available_offsets()
+        except KafkaException as e:
+            logger.warning(f"Could not get latest offsets: {e}")
+            return None
+        with self.lock:
+            offsets = dict(self.offsets)
+        return {
+            partition_id: max(response.offset[0] - offsets.get(partition_id, -1) - 1, 0)
+            for partition_id, response in latest.items()
+        }
+
+    def count(self, event_type):
+        with self.lock:
+            return len(self.positions[event_type])
+
+    def stats(self):
+        """ Returns: counts per type and the next offset per partition they include, read together """
+        with self.lock:
+            return {
+                "num_chats": len(self.positions["chat"]),
+                "num_donations": len(self.positions["donation"]),
+                "offsets": {str(pid): offset + 1 for pid, offset in self.offsets.items()},
+            }
+
+    def position(self, event_type, index):
+        """ Returns: (partition ID, offset) of the index-th event of a type, or None """
+        with self.lock:
+            positions = self.positions[event_type]
+            if 0 <= index < len(positions):
+                return positions[index]
+        return None
+
+    def ids(self, event_type, start_id=None, end_id=None, bucket=None, buckets=None, start_offsets=None):
+        """
+        start_offsets: partition ID -> first offset to return, with the
+        partition and offset of each event. Partitions left out start at 0.
+        """
+        if start_offsets is None:
+            with self.lock:
+                event_ids = list(self.event_ids[event_type])
+            return [
+                {"event_id": event_id, "trace_id": trace_id}
+                for event_id, trace_id in event_ids
+                if in_id_range(event_id, start_id, end_id) and in_bucket(event_id, bucket, buckets)
+            ]
+
+        with self.lock:
+            positions = self.positions[event_type]
+            # Offsets of a partition rise through the list, so scanning back can
+            # stop once every partition has an event before its start offset
+            pending = set(self.offsets)
+            first = len(positions)
+            while first > 0 and pending:
+                first -= 1
+                partition_id, offset = positions[first]
+                if offset < start_offsets.get(partition_id, 0):
+                    pending.discard(partition_id)
+            events = list(zip(positions[first:], self.event_ids[event_type][first:]))
+        return [
+            {"event_id": event_id, "trace_id": trace_id, "partition": partition_id, "offset": offset}
+            for (partition_id, offset), (event_id, trace_id) in events
+            if offset >= start_offsets.get(partition_id, 0)
+            and in_id_range(event_id, start_id, end_id) and in_bucket(event_id, bucket, buckets)
+        ]
+
+    def fetch(self, partition_id, offset):
+        """ Reads the single message at a partition/offset """
+        return kafka_pool.fetch(partition_id, offset)
+
+event_index = EventIndex(f"{KAFKA_HOST}:{KAFKA_PORT}", KAFKA_TOPIC, INDEX_SNAPSHOT_FILE) if INDEX_ENABLED else None
+
 def get_events():
-    client = KafkaClient(hosts=f"{KAFKA_HOST}:{KAFKA_PORT}")
-    topic = client.topics[str.encode(KAFKA_TOPIC)]
-    consumer = topic.get_simple_consumer(reset_offset_on_start=True, consumer_timeout_ms=1000)
-    return consumer
+    return kafka_pool.messages()
+
+class ResponseCache:
+    """
+    LRU cache of handler responses keyed on endpoint and parameters. Each entry
+    keeps the topic offsets it was computed at and is dropped once they move
+    on, or after ttl_s. Bounded by entry count and by total JSON size.
+    """
+    def __init__(self, max_entries, max_bytes, ttl_s):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def get(self, key, watermark):
+        """ Returns: (body, status, ETag) or None """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                body, status, etag, size, entry_watermark, created = entry
+                expired = time.time() - created > self.ttl_s
+                if expired or (entry_watermark is not None and entry_watermark != watermark):
+                    self.remove(key)
+                    self.stats["invalidations"] += 1
+                else:
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return body, status, etag
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, watermark, body, status, etag, size):
+        """ watermark: None keeps the entry however the topic grows, until ttl_s """
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (body, status, etag, size, watermark, time.time())
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def remove(self, key):
+        """ Caller holds the lock """
+        self.size -= self.entries.pop(key)[3]
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.size
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+response_cache = ResponseCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_TTL_S) if CACHE_ENABLED else None
+
+def get_watermark():
+    """
+    Offsets the analyzer's answers currently reflect: what the index has
+    consumed, or the high watermarks of the topic when requests replay it.
+    Returns: tuple of (partition ID, offset), or None if Kafka is unavailable
+    """
+    if event_index is not None:
+        with event_index.lock:
+            return tuple(sorted(event_index.offsets.items()))
+    try:
+        latest = kafka_pool.get_topic().latest_available_offsets()
+    except KafkaException as e:
+        logger.warning(f"Kafka error when getting high watermarks: {e}")
+        return None
+    return tuple(sorted((pid, latest[pid].offset[0]) for pid in latest))
+
+def cached_response(pin_found=False):
+    """
+    Serves a handler from response_cache, with an ETag and Cache-Control so
+    browsers and nginx can cache it too.
+    pin_found: keep 200 responses when the topic grows, for lookups by
+    position, since the event at a position never changes
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            if response_cache is None:
+                return handler(*args, **kwargs)
+            key = (handler.__name__, args, tuple(sorted(kwargs.items())))
+            watermark = get_watermark()
+            cached = response_cache.get(key, watermark) if watermark is not None else None
+            if cached is not None:
+                body, status, etag = cached
+            else:
+                result = handler(*args, **kwargs)
+                body, status = result if isinstance(result, tuple) else (result, 200)
+                body_str = json.dumps(body, sort_keys=True)
+                etag = f'"{hashlib.md5(body_str.encode("utf-8")).hexdigest()}"'
+                if watermark is not None:
+                    entry_watermark = None if pin_found and status == 200 else watermark
+                    response_cache.put(key, entry_watermark, body, status, etag, len(body_str))
+
+            headers = {"ETag": etag, "Cache-Control": f"max-age={CACHE_MAX_AGE_S}"}
+            if status == 200 and request.headers.get("If-None-Match") == etag:
+                return NoContent, 304, headers
+            return body, status, headers
+        return wrapper
+    return decorator
 
 def get_event_index(index, event_type):
+    if event_index is not None:
+        position = event_index.position(event_type, index)
+        if position is None:
+            return None
+        data = event_index.fetch(*position)
+        return data["payload"] if data else None
+
     events = get_events()
     counter = 0
     event = None
     for msg in events:
-        message = msg.value.decode("utf-8")
-        data = json.loads(message)
+        data = decode_message(msg.value)
         if data["type"] == event_type:
             if counter == index:
                 event = data["payload"]
@@ -43,6 +505,8 @@ def get_event_index(index, event_type):
             counter += 1
     return event
 
+@log_latency
+@cached_response(pin_found=True)
 def get_chat(index):
     logger.info(f"Received get chat request for index: {index}")
     chat = get_event_index(index, "chat")
@@ -52,6 +516,8 @@ def get_chat(index):
     else:
         return { "message": f"No chat message at index {index}!"}, 404
 
+@log_latency
+@cached_response(pin_found=True)
 def get_donation(index):
     logger.info(f"Received get donation request for index: {index}")
     donation = get_event_index(index, "donation")
@@ -61,14 +527,22 @@ def get_donation(index):
     else:
         return { "message": f"No donation message at index {index}!"}, 404
 
+@log_latency
+@cached_response()
 def get_event_stats():
     logger.info(f"Received get event stats request")
+    if event_index is not None:
+        stats = event_index.stats()
+        logger.info(stats)
+        return stats
+
     events = get_events()
     num_chats = 0
     num_donations = 0
+    offsets = {}
     for msg in events:
-        message = msg.value.decode("utf-8")
-        data = json.loads(message)
+        data = decode_message(msg.value)
+        offsets[str(msg.partition_id)] = msg.offset + 1
         if data["type"] == "chat":
             num_chats += 1
         elif data["type"] == "donation":
@@ -76,32 +550,113 @@ def get_event_stats():
 
     stats = {
         "num_chats": num_chats,
-        "num_donations": num_donations
+        "num_donations": num_donations,
+        "offsets": offsets,
     }
     logger.info(stats)
 
     return stats
 
-def get_event_ids(event_type):
+def in_id_range(event_id, start_id, end_id):
+    """ Case-insensitive event ID range check, matching the storage DB collation """
+    event_id = event_id.lower()
+    if start_id is not None and event_id < start_id.lower():
+        return False
+    if end_id is not None and event_id >= end_id.lower():
+        return False
+    return True
+
+def id_bucket(event_id, buckets):
+    """ Bucket of an event: first 32 bits of MD5(event_id) modulo buckets, as in storage """
+    return int(hashlib.md5(event_id.encode("utf-8")).hexdigest()[:8], 16) % buckets
+
+def id_hash(event_id, trace_id):
+    """ Hash of an event: first 64 bits of MD5(event_id|trace_id), as in storage """
+    return int(hashlib.md5(f"{event_id}|{trace_id}".encode("utf-8")).hexdigest()[:16], 16)
+
+def in_bucket(event_id, bucket, buckets):
+    if bucket is None or buckets is None:
+        return True
+    return id_bucket(event_id, buckets) == bucket
+
+def parse_offsets(value):
+    """ Parses "partition:offset,..." into partition ID -> offset """
+    offsets = {}
+    for pair in value.split(","):
+        partition_id, offset = pair.split(":")
+        offsets[int(partition_id)] = int(offset)
+    return offsets
+
+def get_event_ids(event_type, start_id=None, end_id=None, bucket=None, buckets=None, start_offsets=None):
     logger.info(f"Received {event_type} event IDs request")
+    if start_offsets is not None:
+        try:
+            start_offsets = parse_offsets(start_offsets)
+        except ValueError:
+            return {"message": f"Invalid start_offsets: {start_offsets}"}, 400
+    if event_index is not None:
+        return event_index.ids(event_type, start_id, end_id, bucket, buckets, start_offsets)
+
     event_ids = []
     events = get_events()
     for msg in events:
-        message = msg.value.decode("utf-8")
-        data = json.loads(message)
-        if data["type"] == event_type:
-            event_ids.append({"event_id": data["payload"]["event_id"], "trace_id": data["payload"]["trace_id"]})
+        if start_offsets is not None and msg.offset < start_offsets.get(msg.partition_id, 0):
+            continue
+        data = decode_message(msg.value)
+        payload = data["payload"]
+        if data["type"] != event_type:
+            continue
+        if in_id_range(payload["event_id"], start_id, end_id) and in_bucket(payload["event_id"], bucket, buckets):
+            event = {"event_id": payload["event_id"], "trace_id": payload["trace_id"]}
+            if start_offsets is not None:
+                event["partition"] = msg.partition_id
+                event["offset"] = msg.offset
+            event_ids.append(event)
     return event_ids
 
-def get_chat_event_ids():
-    return get_event_ids("chat")
+@log_latency
+def get_chat_event_ids(start_id=None, end_id=None, bucket=None, buckets=None, start_offsets=None):
+    return get_event_ids("chat", start_id, end_id, bucket, buckets, start_offsets)
 
-def get_donation_event_ids():
-    return get_event_ids("donation")
+@log_latency
+def get_donation_event_ids(start_id=None, end_id=None, bucket=None, buckets=None, start_offsets=None):
+    return get_event_ids("donation", start_id, end_id, bucket, buckets, start_offsets)
+
+def get_event_digest(event_type, buckets):
+    """ Gets the count and XOR of event hashes per event ID bucket, non-empty buckets only """
+    counts = {}
+    digests = {}
+    for event in get_event_ids(event_type):
+        bucket = id_bucket(event["event_id"], buckets)
+        counts[bucket] = counts.get(bucket, 0) + 1
+        digests[bucket] = digests.get(bucket, 0) ^ id_hash(event["event_id"], event["trace_id"])
+    return {
+        "buckets": buckets,
+        "digests": [
+            {"bucket": bucket, "count": counts[bucket], "digest": f"{digests[bucket]:016x}"}
+            for bucket in sorted(counts)
+        ]
+    }
+
+@log_latency
+@cached_response()
+def get_chat_digest(buckets=256):
+    return get_event_digest("chat", buckets)
+
+@log_latency
+@cached_response()
+def get_donation_digest(buckets=256):
+    return get_event_digest("donation", buckets)
+
+def get_cache_stats():
+    logger.info("Received cache stats request")
+    if response_cache is None:
+        return {"message": "Response cache is disabled"}, 404
+    return response_cache.get_stats()
 
 # Define all required functions
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("livestream.yaml", base_path="/analyzer", strict_validation=True, validate_responses=True)
+app.add_api("livestream.yaml", base_path="/analyzer", strict_validation=True, validate_responses=VALIDATE_RESPONSES)
 
 if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
     app.add_middleware(
@@ -113,5 +668,14 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
         allow_headers=["*"],
     )
 
+app.add_middleware(
+    MetricsMiddleware,
+    position=MiddlewarePosition.BEFORE_EXCEPTION,
+    spec_file="livestream.yaml",
+    base_path="/analyzer",
+)
+
 if __name__ == "__main__":
+    if event_index is not None:
+        event_index.start()
     app.run(port=8110, host="0.0.0.0")
\ No newline at end of file
@@ -3,18 +3,26 @@ import connexion
 import time
 from connexion import NoContent
 import yaml
-import json
 import random
 from pykafka import KafkaClient
 from pykafka.exceptions import KafkaException
 from pykafka.common import OffsetType
 from datetime import datetime as dt, timezone
+import sqlite3
+import base64
+from threading import Thread, Lock, Event
+from rules import RuleEngine, ThresholdRule, build_rules
+from common.codec import decode_message
+from common.metrics import DB_LATENCY, KAFKA_CONSUMED, MetricsMiddleware, observe_event_age, start_lag_monitor
+from connexion.middleware import MiddlewarePosition
 import os
 
 # Get environment vars
 ENVIRONMENT = os.getenv('ENVIRONMENT')
 CHAT_REACTION_COUNT_MIN = os.getenv('CHAT_REACTION_COUNT_MIN')
+CHAT_REACTION_COUNT_MIN = int(CHAT_REACTION_COUNT_MIN) if CHAT_REACTION_COUNT_MIN else None
 DONATION_AMOUNT_MIN = os.getenv('DONATION_AMOUNT_MIN')
+DONATION_AMOUNT_MIN = float(DONATION_AMOUNT_MIN) if DONATION_AMOUNT_MIN else None
 
 # Logging
 with open(f"config/log_conf.{ENVIRONMENT}.yml", "r") as f:
@@ -32,11 +40,21 @@ KAFKA_HOST = app_config["kafka"]["events"]["hostname"]
 KAFKA_PORT = app_config["kafka"]["events"]["port"]
 KAFKA_TOPIC = app_config["kafka"]["events"]["topic"]
 
+DETECTOR_CONSUMER_GROUP = app_config.get("detector", {}).get("consumer_group", "anomaly_group")
+DETECTOR_CONSUMER_TIMEOUT_MS = app_config.get("detector", {}).get("consumer_timeout_ms", 1000)
+DETECTOR_FLUSH_INTERVAL_S = app_config.get("detector", {}).get("flush_interval_s", 5)
+DETECTOR_MAX_ANOMALIES = app_config.get("detector", {}).get("max_anomalies", 10000)
+DETECTOR_BATCH_SIZE = app_config.get("detector", {}).get("batch_size", 500)
+
+PAGE_MAX_LIMIT = app_config.get("pagination", {}).get("max_limit", 1000)
+
 class KafkaWrapper:
     """ Kafka wrapper for consumer """
-    def __init__(self, hostname, topic):
+    def __init__(self, hostname, topic, consumer_group, consumer_timeout_ms=-1):
         self.hostname = hostname
         self.topic = topic
+        self.consumer_group = consumer_group
+        self.consumer_timeout_ms = consumer_timeout_ms
         self.client = None
         self.consumer = None
         self.connect()
@@ -80,10 +98,12 @@ class KafkaWrapper:
             return False
         try:
             topic = self.client.topics[str.encode(self.topic)]
+            # Own consumer group, so detection resumes from its committed offsets
             self.consumer = topic.get_simple_consumer(
-                consumer_group=b'event_group',
-                reset_offset_on_start=True,
-                auto_offset_reset=OffsetType.LATEST
+                consumer_group=str.encode(self.consumer_group),
+                reset_offset_on_start=False,
+                auto_offset_reset=OffsetType.EARLIEST,
+                consumer_timeout_ms=self.consumer_timeout_ms
             )
             logger.info("Kafka consumer created")
         except KafkaException as e:
@@ -94,13 +114,17 @@ class KafkaWrapper:
             return False
 
     def messages(self):
-        """Generator method that catches exceptions in the consumer loop"""
+        """
+        Generator method that catches exceptions in the consumer loop.
+        Yields None when no message arrived within consumer_timeout_ms.
+        """
         if self.consumer is None:
             self.connect()
         while True:
             try:
                 for msg in self.consumer:
                     yield msg
+                yield None
             except KafkaException as e:
                 msg = f"Kafka issue in consumer: {e}"
                 logger.warning(msg)
@@ -108,82 +132,307 @@ class KafkaWrapper:
                 self.consumer = None
                 self.connect()
 
-kafka_wrapper = KafkaWrapper(f"{KAFKA_HOST}:{KAFKA_PORT}", KAFKA_TOPIC)
+kafka_wrapper = KafkaWrapper(
+    f"{KAFKA_HOST}:{KAFKA_PORT}", KAFKA_TOPIC, DETECTOR_CONSUMER_GROUP, DETECTOR_CONSUMER_TIMEOUT_MS
+)
+
+class AnomalyStore:
+    """
+    SQLite store of the latest anomalies, indexed by event type, anomaly type
+    and detection time. Keeps at most max_anomalies, dropping the oldest.
+    """
+    def __init__(self, filename, max_anomalies):
+        self.filename = filename
+        self.max_anomalies = max_anomalies
+        self.lock = Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS anomalies (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    event_id TEXT NOT NULL,
+                    trace_id TEXT NOT NULL,
+                    event_type TEXT NOT NULL,
+                    anomaly_type TEXT NOT NULL,
+                    description TEXT NOT NULL,
+                    detected_at TEXT NOT NULL,
+                    UNIQUE (event_id, anomaly_type)
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ix_anomalies_event_type ON anomalies (event_type, id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ix_anomalies_anomaly_type ON anomalies (anomaly_type, id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ix_anomalies_detected_at ON anomalies (detected_at)")
+
+    def add_many(self, anomalies):
+        """
+        Appends anomalies in one transaction, skipping events that already have that type of anomaly.
+        Returns: number of anomalies added
+        """
+        detected_at = dt.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        rows = [
+            (a["event_id"], a["trace_id"], a["event_type"], a["anomaly_type"], a["description"], detected_at)
+            for a in anomalies
+        ]
+        with self.lock, self.conn, DB_LATENCY.labels("anomalies_insert").time():
+            before = self.conn.total_changes
+            self.conn.executemany("""
+                INSERT OR IGNORE INTO anomalies (event_id, trace_id, event_type, anomaly_type, description, detected_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, rows)
+            return self.conn.total_changes - before
+
+    def prune(self):
+        """ Drops the oldest anomalies past max_anomalies """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM anomalies WHERE id < (SELECT id FROM anomalies ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (self.max_anomalies - 1,)
+            )
+
+    def query(self, event_type=None, anomaly_type=None, since=None, after_id=None, limit=None):
+        """ Returns: anomalies matching every given filter, in detection order """
+        clauses = []
+        params = []
+        for column, value, operator in [
+            ("event_type", event_type, "="),
+            ("anomaly_type", anomaly_type, "="),
+            ("detected_at", since, ">="),
+            ("id", after_id, ">"),
+        ]:
+            if value is not None:
+                clauses.append(f"{column} {operator} ?")
+                params.append(value)
+        statement = "SELECT * FROM anomalies"
+        if clauses:
+            statement += " WHERE " + " AND ".join(clauses)
+        statement += " ORDER BY id"
+        if limit is not None:
+            statement += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(statement, params)]
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM anomalies").fetchone()[0]
+
+anomaly_store = AnomalyStore(DATA_FILE, DETECTOR_MAX_ANOMALIES)
+
+flush_requested = Event()
+detector_stats_lock = Lock()
+detector_stats = {
+    "messages_processed": 0,
+    "anomalies_detected": 0,
+    "offsets": {},
+    "last_flush": None,
+}
+
+def make_rules():
+    """ Rules from the config, plus the threshold env vars when they are set """
+    rules = build_rules(app_config.get("rules"))
+    if CHAT_REACTION_COUNT_MIN is not None:
+        rules.setdefault("chat", []).insert(0, ThresholdRule("chat", "reaction_count", min=CHAT_REACTION_COUNT_MIN))
+    if DONATION_AMOUNT_MIN is not None:
+        rules.setdefault("donation", []).insert(0, ThresholdRule("donation", "amount", min=DONATION_AMOUNT_MIN))
+    for event_type, event_rules in rules.items():
+        logger.info(f"{event_type} anomaly rules: {[type(rule).__name__ for rule in event_rules]}")
+    return rules
+
+rule_engine = RuleEngine(make_rules())
+
+def flush():
+    """
+    Commits the offsets of evaluated events and drops anomalies past max_anomalies.
+    Anomalies are saved with each batch, before its offsets can be committed,
+    so a restart never skips events whose anomalies were not saved.
+    """
+    anomaly_store.prune()
+    consumer = kafka_wrapper.consumer
+    if consumer is not None:
+        # Only offsets of evaluated events, the consumer's own also cover the batch in progress
+        with detector_stats_lock:
+            offsets = dict(detector_stats["offsets"])
+        partition_offsets = [
+            (consumer.partitions[partition_id], offset)
+            for partition_id, offset in offsets.items()
+            if partition_id in consumer.partitions
+        ]
+        try:
+            if partition_offsets:
+                consumer.commit_offsets(partition_offsets=partition_offsets)
+        except KafkaException as e:
+            # Offsets are committed again on the next flush
+            logger.warning(f"Kafka error when committing offsets: {e}")
+            return
+    with detector_stats_lock:
+        detector_stats["last_flush"] = dt.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    logger.debug("Anomalies flushed and offsets committed")
+
+def detect_anomalies():
+    """
+    Evaluates events in micro-batches of up to detector.batch_size as they arrive,
+    flushing every flush_interval_s or when requested.
+    Offsets of a batch are only committed once it has been evaluated.
+    """
+    last_flush = time.time()
+    batch = []
+    # Next offset per partition of the messages read since the last evaluation
+    pending = {}
+    # First offset per partition of the batch in progress
+    batch_start = {}
+    # Partitions that had a batch fail evaluation, their offsets are not committed past it
+    held = set()
+    # This is blocking - it will wait for a new message
+    for msg in kafka_wrapper.messages():
+        if msg is not None:
+            KAFKA_CONSUMED.labels(KAFKA_TOPIC, "anomaly_detector").inc()
+            pending[msg.partition_id] = msg.offset + 1
+            try:
+                event = decode_message(msg.value)
+                rule_engine.validate(event)
+            except ValueError as e:
+                # Skipped on its own, the rest of the batch is still evaluated
+                logger.error(f"Skipping malformed message at offset {msg.offset}: {e}")
+            else:
+                batch.append(event)
+                batch_start.setdefault(msg.partition_id, msg.offset)
+
+        # An idle consumer evaluates what it has without waiting for a full batch
+        if batch and (msg is None or len(batch) >= DETECTOR_BATCH_SIZE):
+            try:
+                anomalies = rule_engine.evaluate(batch)
+            except (KeyError, TypeError, ValueError) as e:
+                # Events were validated, so this is a rule bug. The batch's offsets are held
+                # back, so its events are evaluated again after a restart.
+                logger.error(f"Batch of {len(batch)} events failed evaluation, holding partitions {sorted(batch_start)}: {e}")
+                held.update(batch_start)
+            else:
+                added = anomaly_store.add_many(anomalies)
+                with detector_stats_lock:
+                    detector_stats["messages_processed"] += len(batch)
+                    detector_stats["anomalies_detected"] += added
+                for event in batch:
+                    observe_event_age("detected", event)
+            batch = []
+            batch_start = {}
+
+        if not batch and pending:
+            with detector_stats_lock:
+                for partition_id, offset in pending.items():
+                    if partition_id not in held:
+                        detector_stats["offsets"][partition_id] = offset
+            pending = {}
+
+        if not batch and (flush_requested.is_set() or time.time() - last_flush >= DETECTOR_FLUSH_INTERVAL_S):
+            flush_requested.clear()
+            flush()
+            last_flush = time.time()
+
+def setup_kafka_thread():
+    t1 = Thread(target=detect_anomalies)
+    t1.setDaemon(True)
+    t1.start()
+    start_lag_monitor(KAFKA_TOPIC, "anomaly_detector", get_detector_lag)
+
+def get_partition_lag(offsets):
+    """ Messages left to evaluate per partition, None if the broker can't be reached """
+    try:
+        latest = kafka_wrapper.consumer.topic.latest_available_offsets()
+    except (AttributeError, KafkaException) as e:
+        logger.warning(f"Could not get latest offsets: {e}")
+        return None
+    return {
+        partition_id: max(response.offset[0] - offsets.get(partition_id, 0), 0)
+        for partition_id, response in latest.items()
+    }
+
+def get_lag(offsets):
+    """ Messages left to evaluate over all partitions, None if the broker can't be reached """
+    lag = get_partition_lag(offsets)
+    return sum(lag.values()) if lag is not None else None
+
+def get_detector_lag():
+    with detector_stats_lock:
+        offsets = dict(detector_stats["offsets"])
+    return get_partition_lag(offsets)
 
 def update_anomalies():
+    """ Asks the detector to flush and returns how far detection has progressed """
     logger.debug("Update anomalies request recieved")
-    start_time = time.time()
+    flush_requested.set()
 
-    anomalies_count = 0
-    anomalies = []
+    with detector_stats_lock:
+        stats = dict(detector_stats)
+        offsets = dict(detector_stats["offsets"])
+    status = {
+        "anomalies_count": anomaly_store.count(),
+        "anomalies_detected": stats["anomalies_detected"],
+        "messages_processed": stats["messages_processed"],
+        "offsets": {str(partition_id): offset for partition_id, offset in offsets.items()},
+        "last_flush": stats["last_flush"],
+    }
+    lag = get_lag(offsets)
+    if lag is not None:
+        status["lag"] = lag
+    logger.info(f"Anomaly detection status | processed={status['messages_processed']} | lag={lag}")
 
-    for msg in kafka_wrapper.messages():
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message: %s" % msg)
-        payload = msg["payload"]
-        if msg["type"] == "chat":
-            if payload["reaction_count"] < CHAT_REACTION_COUNT_MIN:
-                logger.debug(f"Chat event anomaly added. Detected: {payload["reaction_count"]}; too low (threshold {CHAT_REACTION_COUNT_MIN}")
-                anomalies.append({
-                    "event_id" : payload["event_id"],
-                    "trace_id" : payload["trace_id"],
-                    "event_type" : msg["type"],
-                    "anomaly_type" : "Too Low",
-                    "description" : f"Detected: {payload["reaction_count"]}; too low (threshold {CHAT_REACTION_COUNT_MIN})",
-                })
-                anomalies_count += 1
-        elif msg["type"] == "donation":
-            if payload["amount"] < DONATION_AMOUNT_MIN:
-                logger.debug(f"Donation event anomaly added. Detected: {payload["amount"]}; too low (threshold {DONATION_AMOUNT_MIN}")
-                anomalies.append({
-                    "event_id" : payload["event_id"],
-                    "trace_id" : payload["trace_id"],
-                    "event_type" : msg["type"],
-                    "anomaly_type" : "Too Low",
-                    "description" : f"Detected: {payload["amount"]}; too low (threshold {DONATION_AMOUNT_MIN})",
-                })
-                anomalies_count += 1
-
-    with open(DATA_FILE, "w") as fd:
-        json.dump(anomalies, fd, indent=4)
-
-    processing_time_ms = int((time.time() - start_time) * 1000)
-    logger.info(f"Anomalies updated | processing_time_ms={processing_time_ms}")
-
-    return {"anomalies_count": anomalies_count}, 201
-
-def get_anomalies(event_type=None):
+    return status, 201
+
+def encode_cursor(id):
+    """ Opaque keyset cursor for the anomaly after id """
+    return base64.urlsafe_b64encode(str(id).encode("utf-8")).decode("utf-8")
+
+def decode_cursor(cursor):
+    """ Returns: id of a keyset cursor """
+    return int(base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8"))
+
+def get_anomalies(event_type=None, anomaly_type=None, since=None, limit=None, cursor=None):
     logger.debug("Anomalies request recieved")
     
     if event_type is not None and event_type not in ["chat", "donation"]:
         logger.error(f"Invalid event_type: {event_type}")
         return {"message": f"Invalid event_type: {event_type}"}, 400
 
-    try:
-        with open(DATA_FILE, "r") as fd:
-            data = json.load(fd)
-            logger.debug(data)
-    except:
-        logger.error("Failed to get anomalies, data file does not exist yet")
-        return {"message": "No anomailes available"}, 404
-    
-    if event_type is None:
-        anomalies = data
-    else:
-        anomalies = [a for a in data if a["event_type"] == event_type]
+    after_id = None
+    if cursor is not None:
+        try:
+            after_id = decode_cursor(cursor)
+        except ValueError:
+            return {"message": f"Invalid cursor: {cursor}"}, 400
+    if since is not None:
+        # Detection times are stored as UTC strings that sort by time
+        since = dt.fromisoformat(since.replace("Z", "+00:00")).astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    limit = min(limit or PAGE_MAX_LIMIT, PAGE_MAX_LIMIT)
+    # One extra row tells whether there is a next page
+    anomalies = anomaly_store.query(event_type, anomaly_type, since, after_id, limit + 1)
     
     if len(anomalies) == 0:
         logger.debug("No anomalies found")
         return NoContent, 204
-    else:
-        logger.debug("Anomalies request processed")
-        return anomalies, 200
+
+    headers = {}
+    if len(anomalies) > limit:
+        anomalies = anomalies[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(anomalies[-1]["id"])
+    for anomaly in anomalies:
+        del anomaly["id"]
+    logger.debug("Anomalies request processed")
+    return anomalies, 200, headers
 
 app = connexion.FlaskApp(__name__, specification_dir='')
 app.add_api("anomaly.yaml", base_path="/anomaly_detector", strict_validation=True, validate_responses=True)
+app.add_middleware(
+    MetricsMiddleware,
+    position=MiddlewarePosition.BEFORE_EXCEPTION,
+    spec_file="anomaly.yaml",
+    base_path="/anomaly_detector",
+)
 
 if __name__ == "__main__":
     logger.info(f"Chat event - reaction_count threshold: {CHAT_REACTION_COUNT_MIN}")
     logger.info(f"Donation event - amount threshold: {DONATION_AMOUNT_MIN}")
+    setup_kafka_thread()
     app.run(port=8130, host="0.0.0.0")
\ No newline at end of file
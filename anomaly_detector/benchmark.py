@@ -0,0 +1,74 @@
+"""
+Replays synthetic events through the anomaly rules and reports events/sec.
+
+    python3 benchmark.py --events 1000000 --batch-size 500
+
+Messages are encoded up front with the given codec, so the timing covers
+decoding and rule evaluation, as in the detector, but not Kafka.
+"""
+import argparse
+import random
+import time
+import uuid
+from datetime import datetime as dt, timedelta, timezone
+import yaml
+from common.codec import CODECS, decode_message, encode_message, get_codec
+from rules import RuleEngine, ThresholdRule, build_rules
+
+def make_messages(num_events, num_users, codec):
+    users = [str(uuid.uuid4()) for _ in range(num_users)]
+    start = dt(2025, 1, 1, tzinfo=timezone.utc)
+    messages = []
+    for i in range(num_events):
+        timestamp = (start + timedelta(milliseconds=i * 10)).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+        payload = {
+            "event_id": str(uuid.uuid4()),
+            "trace_id": str(uuid.uuid4()),
+            "user_id": random.choice(users),
+            "message": "Hello chat!",
+            "timestamp": timestamp,
+        }
+        if random.random() < 0.8:
+            event_type = "chat"
+            payload["reaction_count"] = int(random.expovariate(0.1))
+        else:
+            event_type = "donation"
+            payload["amount"] = round(random.lognormvariate(2, 1), 2)
+            payload["currency"] = "CAD"
+        messages.append(encode_message({"type": event_type, "payload": payload}, codec))
+    return messages
+
+def make_engine(config_file):
+    with open(config_file, "r") as f:
+        rules = build_rules(yaml.safe_load(f.read()).get("rules"))
+    rules.setdefault("chat", []).insert(0, ThresholdRule("chat", "reaction_count", min=1))
+    rules.setdefault("donation", []).insert(0, ThresholdRule("donation", "amount", min=1))
+    return RuleEngine(rules)
+
+def run(messages, engine, batch_size):
+    anomalies = 0
+    start_time = time.perf_counter()
+    for start in range(0, len(messages), batch_size):
+        batch = [decode_message(msg) for msg in messages[start:start + batch_size]]
+        anomalies += len(engine.evaluate(batch))
+    return time.perf_counter() - start_time, anomalies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=1000000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--config", default="../config/anomaly_detector/app_conf.dev.yml")
+    parser.add_argument("--codec", default="json", choices=list(CODECS))
+    args = parser.parse_args()
+
+    print(f"Generating {args.events} events...")
+    messages = make_messages(args.events, args.users, get_codec(args.codec))
+    engine = make_engine(args.config)
+
+    elapsed, anomalies = run(messages, engine, args.batch_size)
+    print(f"events={args.events} batch_size={args.batch_size} codec={args.codec} anomalies={anomalies}")
+    print(f"elapsed_s={elapsed:.2f} events_per_s={args.events / elapsed:,.0f}")
+
+if __name__ == "__main__":
+    main()
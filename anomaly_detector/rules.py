@@ -0,0 +1,291 @@
+import abc
+import math
+from datetime import datetime as dt, timezone
+import numpy as np
+
+class EventBatch:
+    """ Decoded events of one type, with fields turned into arrays on first use """
+    def __init__(self, payloads):
+        self.payloads = payloads
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def values(self, field):
+        if field not in self.columns:
+            self.columns[field] = np.array([p[field] for p in self.payloads], dtype=np.float64)
+        return self.columns[field]
+
+    def user_ids(self):
+        if "user_id" not in self.columns:
+            self.columns["user_id"] = np.array([p["user_id"] for p in self.payloads], dtype=object)
+        return self.columns["user_id"]
+
+    def timestamps(self):
+        """ Event timestamps as epoch seconds """
+        if "timestamp" not in self.columns:
+            timestamps = [p["timestamp"] for p in self.payloads]
+            try:
+                parsed = np.array([t.rstrip("Z") for t in timestamps], dtype="datetime64[ms]")
+                seconds = parsed.astype(np.int64) / 1000
+            except (AttributeError, ValueError):
+                # Timestamps with an explicit UTC offset, or ones that can't be read
+                seconds = np.array([parse_seconds(t) for t in timestamps], dtype=np.float64)
+            self.columns["timestamp"] = seconds
+        return self.columns["timestamp"]
+
+def parse_seconds(timestamp):
+    """ Returns: epoch seconds of an ISO 8601 timestamp, UTC unless it has an offset, or NaN if it can't be read """
+    try:
+        value = dt.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return math.nan
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+def linear_recurrence(inputs, decay, initial):
+    """
+    Solves y[t] = decay * y[t-1] + inputs[t] for every t without a Python loop.
+    Runs in chunks so decay ** -k stays within float64 range.
+    Returns: y
+    """
+    chunk = max(1, min(256, int(300 / max(-math.log10(decay), 1e-9)))) if decay > 0 else 1
+    result = np.empty(len(inputs), dtype=np.float64)
+    for start in range(0, len(inputs), chunk):
+        b = inputs[start:start + chunk]
+        powers = decay ** np.arange(1, len(b) + 1)
+        result[start:start + chunk] = powers * (initial + np.cumsum(b / powers))
+        initial = result[start + len(b) - 1]
+    return result
+
+class Rule(abc.ABC):
+    """
+    An anomaly rule for one event type. Rules keep whatever history they
+    need between batches, so a batch is evaluated against earlier events.
+    """
+    def __init__(self, event_type, field=None):
+        self.event_type = event_type
+        self.field = field
+
+    def check(self, payload):
+        """ Raises ValueError if the rule can't read the payload """
+        if self.field is not None:
+            value = payload.get(self.field)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{self.field} is not a number: {value!r}")
+
+    @abc.abstractmethod
+    def evaluate(self, batch):
+        """ Returns: list of (index in batch, anomaly_type, description) """
+
+class ThresholdRule(Rule):
+    """ Flags values below min or above max """
+    def __init__(self, event_type, field, min=None, max=None):
+        super().__init__(event_type, field)
+        self.min = min
+        self.max = max
+
+    def evaluate(self, batch):
+        values = batch.values(self.field)
+        anomalies = []
+        if self.min is not None:
+            for i in np.flatnonzero(values < self.min):
+                anomalies.append((i, "Too Low", f"Detected: {format_value(values[i])}; too low (threshold {self.min})"))
+        if self.max is not None:
+            for i in np.flatnonzero(values > self.max):
+                anomalies.append((i, "Too High", f"Detected: {format_value(values[i])}; too high (threshold {self.max})"))
+        return anomalies
+
+class ZScoreRule(Rule):
+    """ Flags values more than threshold standard deviations from the mean of the previous window values """
+    def __init__(self, event_type, field, window=1000, threshold=3.0, min_count=30):
+        super().__init__(event_type, field)
+        self.window = window
+        self.threshold = threshold
+        self.min_count = min_count
+        self.history = np.empty(0, dtype=np.float64)
+
+    def evaluate(self, batch):
+        values = batch.values(self.field)
+        series = np.concatenate([self.history, values])
+        offset = len(self.history)
+
+        # Sums over series[i - window:i] for each batch position i
+        sums = np.concatenate([[0.0], np.cumsum(series)])
+        squares = np.concatenate([[0.0], np.cumsum(series * series)])
+        ends = np.arange(offset, len(series))
+        starts = np.maximum(ends - self.window, 0)
+        counts = ends - starts
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = (sums[ends] - sums[starts]) / counts
+            variances = (squares[ends] - squares[starts]) / counts - means * means
+            scores = (values - means) / np.sqrt(np.maximum(variances, 0))
+        flagged = (counts >= self.min_count) & np.isfinite(scores) & (np.abs(scores) > self.threshold)
+
+        self.history = series[-self.window:]
+        return [
+            (i, "Z-Score", f"Detected: {format_value(values[i])}; z-score {scores[i]:.2f} (threshold {self.threshold})")
+            for i in np.flatnonzero(flagged)
+        ]
+
+class EWMARule(Rule):
+    """ Flags values more than threshold deviations from an exponentially weighted moving average """
+    def __init__(self, event_type, field, alpha=0.05, threshold=3.0, min_count=30):
+        super().__init__(event_type, field)
+        self.alpha = alpha
+        self.threshold = threshold
+        self.min_count = min_count
+        self.mean = None
+        self.variance = 0.0
+        self.count = 0
+
+    def evaluate(self, batch):
+        values = batch.values(self.field)
+        if len(values) == 0:
+            return []
+        if self.mean is None:
+            self.mean = values[0]
+        decay = 1 - self.alpha
+
+        # means[t] is the average after values[t], shifted so each value is compared to the one before it
+        means = linear_recurrence(self.alpha * values, decay, self.mean)
+        previous_means = np.concatenate([[self.mean], means[:-1]])
+        deviations = values - previous_means
+        variances = linear_recurrence(decay * self.alpha * deviations * deviations, decay, self.variance)
+        previous_variances = np.concatenate([[self.variance], variances[:-1]])
+
+        seen = self.count + np.arange(len(values))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = deviations / np.sqrt(previous_variances)
+        flagged = (seen >= self.min_count) & np.isfinite(scores) & (np.abs(scores) > self.threshold)
+
+        self.mean = means[-1]
+        self.variance = variances[-1]
+        self.count += len(values)
+        return [
+            (i, "EWMA Deviation", f"Detected: {format_value(values[i])}; expected {format_value(previous_means[i])} (threshold {self.threshold} deviations)")
+            for i in np.flatnonzero(flagged)
+        ]
+
+class UserRateRule(Rule):
+    """ Flags events of users that sent more than max_events within window_s seconds """
+    def __init__(self, event_type, max_events=10, window_s=60):
+        super().__init__(event_type)
+        self.max_events = max_events
+        self.window_s = window_s
+        self.history_users = np.empty(0, dtype=object)
+        self.history_times = np.empty(0, dtype=np.float64)
+
+    def check(self, payload):
+        # Unreadable timestamps are skipped by evaluate, missing ones are not
+        for key in ("user_id", "timestamp"):
+            if key not in payload:
+                raise ValueError(f"missing {key}")
+        if not isinstance(payload["user_id"], (str, int)):
+            raise ValueError(f"user_id is not an ID: {payload['user_id']!r}")
+
+    def evaluate(self, batch):
+        if len(batch) == 0:
+            return []
+        # Events without a readable timestamp can't be placed in a window
+        valid = np.flatnonzero(~np.isnan(batch.timestamps()))
+        if len(valid) == 0:
+            return []
+        users = np.concatenate([self.history_users, batch.user_ids()[valid]])
+        times = np.concatenate([self.history_times, batch.timestamps()[valid]])
+        offset = len(self.history_users)
+
+        # Sort by (user, time) on one key, so each user's events are contiguous and ordered.
+        # Users are numbered with a dict, sorting the string IDs themselves is far slower.
+        numbers = {}
+        codes = np.array([numbers.setdefault(user, len(numbers)) for user in users], dtype=np.float64)
+        relative = times - times.min()
+        span = relative.max() + self.window_s + 1
+        keys = codes * span + relative
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        in_window = np.arange(len(keys)) - np.searchsorted(sorted_keys, sorted_keys - self.window_s, side="left") + 1
+        counts = np.empty(len(keys), dtype=np.int64)
+        counts[order] = in_window
+
+        batch_counts = counts[offset:]
+        flagged = np.flatnonzero(batch_counts > self.max_events)
+
+        keep = times > times.max() - self.window_s
+        self.history_users = users[keep]
+        self.history_times = times[keep]
+        return [
+            (valid[i], "User Rate Spike", f"Detected: {batch_counts[i]} events in {self.window_s}s; too many (threshold {self.max_events})")
+            for i in flagged
+        ]
+
+RULE_TYPES = {
+    "threshold": ThresholdRule,
+    "zscore": ZScoreRule,
+    "ewma": EWMARule,
+    "user_rate": UserRateRule,
+}
+
+def format_value(value):
+    return int(value) if float(value).is_integer() else round(float(value), 2)
+
+def build_rules(config):
+    """
+    Builds rules from config: event type -> list of {type, ...rule options}
+    Returns: event type -> list of rules
+    """
+    rules = {}
+    for event_type, rule_configs in (config or {}).items():
+        for rule_config in rule_configs:
+            options = dict(rule_config)
+            rule_type = options.pop("type")
+            if rule_type not in RULE_TYPES:
+                raise ValueError(f"Unknown anomaly rule type: {rule_type}")
+            rules.setdefault(event_type, []).append(RULE_TYPES[rule_type](event_type, **options))
+    return rules
+
+class RuleEngine:
+    """ Evaluates the rules of each event type over micro-batches of decoded events """
+    def __init__(self, rules):
+        self.rules = rules
+
+    def validate(self, message):
+        """
+        Checks a decoded event message before it is batched, so one bad event
+        can't fail the evaluation of a whole batch.
+        Raises ValueError if the event can't be evaluated.
+        """
+        if not isinstance(message, dict) or not isinstance(message.get("payload"), dict):
+            raise ValueError("message has no payload")
+        payload = message["payload"]
+        for key in ("event_id", "trace_id"):
+            if key not in payload:
+                raise ValueError(f"missing {key}")
+        for rule in self.rules.get(message.get("type"), []):
+            rule.check(payload)
+
+    def evaluate(self, messages):
+        """
+        messages: decoded event messages, in queue order
+        Returns: list of anomalies
+        """
+        payloads = {}
+        for msg in messages:
+            payloads.setdefault(msg["type"], []).append(msg["payload"])
+
+        anomalies = []
+        for event_type, event_payloads in payloads.items():
+            batch = EventBatch(event_payloads)
+            for rule in self.rules.get(event_type, []):
+                for i, anomaly_type, description in rule.evaluate(batch):
+                    payload = event_payloads[i]
+                    anomalies.append({
+                        "event_id" : payload["event_id"],
+                        "trace_id" : payload["trace_id"],
+                        "event_type" : event_type,
+                        "anomaly_type" : anomaly_type,
+                        "description" : description,
+                    })
+        return anomalies
@@ -0,0 +1,108 @@
+import math
+import numpy as np
+import pytest
+from rules import EventBatch, EWMARule, Rule, RuleEngine, ThresholdRule, UserRateRule, ZScoreRule, build_rules, parse_seconds
+
+def donation(i, amount, user_id="user-1", timestamp=None):
+    return {
+        "type": "donation",
+        "payload": {
+            "event_id": f"event-{i}",
+            "trace_id": f"trace-{i}",
+            "user_id": user_id,
+            "amount": amount,
+            "timestamp": timestamp or f"2025-01-01T00:00:{i % 60:02d}.000Z",
+        },
+    }
+
+def test_timestamps_read_utc_and_offsets():
+    batch = EventBatch([
+        {"timestamp": "2025-01-01T00:00:00.000Z"},
+        {"timestamp": "2025-01-01T01:00:00+01:00"},
+    ])
+    assert list(batch.timestamps()) == [1735689600.0, 1735689600.0]
+
+def test_unreadable_timestamps_are_nan():
+    batch = EventBatch([{"timestamp": "2025-01-01T00:00:00Z"}, {"timestamp": "yesterday"}, {"timestamp": None}])
+    timestamps = batch.timestamps()
+    assert timestamps[0] == 1735689600.0
+    assert np.isnan(timestamps[1]) and np.isnan(timestamps[2])
+
+def test_parse_seconds_naive_is_utc():
+    assert parse_seconds("2025-01-01T00:00:00") == 1735689600.0
+    assert math.isnan(parse_seconds("not a date"))
+
+def test_threshold_rule():
+    rule = ThresholdRule("donation", "amount", min=1, max=100)
+    batch = EventBatch([donation(i, amount)["payload"] for i, amount in enumerate([0.5, 50, 500])])
+    assert [(i, anomaly_type) for i, anomaly_type, _ in rule.evaluate(batch)] == [(0, "Too Low"), (2, "Too High")]
+
+@pytest.mark.parametrize("rule", [
+    ZScoreRule("donation", "amount", window=100, threshold=3.0, min_count=30),
+    EWMARule("donation", "amount", alpha=0.05, threshold=3.0, min_count=30),
+])
+def test_deviation_rules_flag_only_the_outlier(rule):
+    rng = np.random.default_rng(0)
+    amounts = list(rng.normal(10, 1, 200)) + [100.0]
+    batch = EventBatch([donation(i, amount)["payload"] for i, amount in enumerate(amounts)])
+    assert [i for i, _, _ in rule.evaluate(batch)] == [200]
+
+def test_deviation_rules_carry_history_across_batches():
+    rule = ZScoreRule("donation", "amount", window=100, threshold=3.0, min_count=30)
+    rng = np.random.default_rng(1)
+    assert rule.evaluate(EventBatch([donation(i, a)["payload"] for i, a in enumerate(rng.normal(10, 1, 100))])) == []
+    flagged = rule.evaluate(EventBatch([donation(0, 10.0)["payload"], donation(1, 100.0)["payload"]]))
+    assert [i for i, _, _ in flagged] == [1]
+
+def test_user_rate_rule_counts_within_window():
+    rule = UserRateRule("donation", max_events=2, window_s=10)
+    payloads = [donation(i, 1, timestamp=f"2025-01-01T00:00:{i:02d}.000Z")["payload"] for i in range(4)]
+    payloads.append(donation(4, 1, user_id="user-2")["payload"])
+    assert [i for i, _, _ in rule.evaluate(EventBatch(payloads))] == [2, 3]
+
+def test_user_rate_rule_skips_unreadable_timestamps():
+    rule = UserRateRule("donation", max_events=1, window_s=60)
+    payloads = [
+        donation(0, 1, timestamp="2025-01-01T00:00:00.000Z")["payload"],
+        donation(1, 1, timestamp="not a date")["payload"],
+        donation(2, 1, timestamp="2025-01-01T00:00:01+00:00")["payload"],
+    ]
+    assert [i for i, _, _ in rule.evaluate(EventBatch(payloads))] == [2]
+
+def test_build_rules_rejects_unknown_type():
+    with pytest.raises(ValueError):
+        build_rules({"donation": [{"type": "median"}]})
+
+def test_engine_maps_anomalies_to_events():
+    engine = RuleEngine(build_rules({"donation": [{"type": "threshold", "field": "amount", "max": 100}]}))
+    anomalies = engine.evaluate([donation(0, 5), donation(1, 500), {"type": "chat", "payload": {}}])
+    assert anomalies == [{
+        "event_id": "event-1",
+        "trace_id": "trace-1",
+        "event_type": "donation",
+        "anomaly_type": "Too High",
+        "description": "Detected: 500; too high (threshold 100)",
+    }]
+
+def test_engine_validate_accepts_readable_events():
+    engine = RuleEngine(build_rules({"donation": [{"type": "zscore", "field": "amount"}, {"type": "user_rate"}]}))
+    engine.validate(donation(0, 5))
+    engine.validate({"type": "chat", "payload": {"event_id": "event-0", "trace_id": "trace-0"}})
+
+@pytest.mark.parametrize("message", [
+    None,
+    {"type": "donation", "payload": "not a dict"},
+    {"type": "donation", "payload": {"trace_id": "trace-0", "amount": 5, "user_id": "u", "timestamp": "t"}},
+    donation(0, "5"),
+    donation(0, None),
+    donation(0, True),
+    {"type": "donation", "payload": {"event_id": "event-0", "trace_id": "trace-0", "amount": 5, "user_id": "u"}},
+])
+def test_engine_validate_rejects_events_the_rules_cant_read(message):
+    engine = RuleEngine(build_rules({"donation": [{"type": "zscore", "field": "amount"}, {"type": "user_rate"}]}))
+    with pytest.raises(ValueError):
+        engine.validate(message)
+
+def test_rule_needs_evaluate():
+    with pytest.raises(TypeError):
+        Rule("donation")
@@ -0,0 +1,62 @@
+"""
+Codecs for the Kafka event envelope: {"type", "datetime", "payload"}.
+
+Every message starts with a version byte naming its codec, so consumers can
+decode anything on the topic whatever the receiver is configured to write.
+Messages written before the version byte are plain JSON and start with "{".
+"""
+import msgpack
+import orjson
+
+LEGACY_JSON = ord("{")
+
+class JSONCodec:
+    """ JSON through orjson, a few times faster than the json module """
+    version = 1
+    name = "json"
+
+    def dumps(self, envelope):
+        return orjson.dumps(envelope)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+class MsgpackCodec:
+    """ MessagePack, smaller than JSON and cheaper to decode """
+    version = 2
+    name = "msgpack"
+
+    def dumps(self, envelope):
+        return msgpack.packb(envelope, use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+CODECS = {codec.name: codec for codec in (JSONCodec(), MsgpackCodec())}
+CODEC_VERSIONS = {codec.version: codec for codec in CODECS.values()}
+
+def get_codec(name):
+    if name not in CODECS:
+        raise ValueError(f"Unknown message codec: {name}")
+    return CODECS[name]
+
+def encode_message(envelope, codec):
+    """ Returns: the version byte of the codec, then the encoded envelope """
+    return bytes([codec.version]) + codec.dumps(envelope)
+
+def decode_message(message):
+    """
+    Decodes a message written with any codec, or as plain JSON.
+    Raises ValueError for an unknown version byte or a malformed message.
+    """
+    if not message:
+        raise ValueError("Empty message")
+    version = message[0]
+    if version == LEGACY_JSON:
+        return orjson.loads(message)
+    if version not in CODEC_VERSIONS:
+        raise ValueError(f"Unknown message codec version: {version}")
+    try:
+        return CODEC_VERSIONS[version].loads(memoryview(message)[1:])
+    except msgpack.UnpackException as e:
+        raise ValueError(f"Malformed message: {e}") from e
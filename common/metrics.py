@@ -0,0 +1,164 @@
+"""
+Prometheus metrics, served on /metrics by MetricsMiddleware.
+
+Shared by every service, each uses the metrics that apply to it. Updates are in-memory counters, so they are cheap on the hot path.
+Metrics that need a broker round trip, like consumer lag, are refreshed
+on a background thread.
+
+With PROMETHEUS_MULTIPROC_DIR set, metrics from forked worker processes
+are merged into /metrics.
+"""
+import os
+import re
+import time
+from datetime import datetime as dt, timezone
+from threading import Thread
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+import yaml
+
+METRICS_PATH = "/metrics"
+UNMATCHED_PATH = "unmatched"
+# prometheus_client picks in-memory or per-process file values when it is imported
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time to answer HTTP requests",
+    ["method", "path", "status"]
+)
+KAFKA_PRODUCED = Counter(
+    "kafka_messages_produced_total", "Messages handed to the Kafka producer, by outcome",
+    ["topic", "result"]
+)
+KAFKA_PRODUCE_LATENCY = Histogram(
+    "kafka_produce_duration_seconds", "Time to produce a message, or a batch, including the ack in sync mode",
+    ["topic", "mode"]
+)
+KAFKA_CONSUMED = Counter(
+    "kafka_messages_consumed_total", "Messages read from Kafka",
+    ["topic", "consumer"]
+)
+KAFKA_CONSUMER_LAG = Gauge(
+    "kafka_consumer_lag", "Messages left to consume per partition",
+    ["topic", "consumer", "partition"],
+    multiprocess_mode="max"
+)
+DB_LATENCY = Histogram(
+    "db_operation_duration_seconds", "Time spent in database operations",
+    ["operation"]
+)
+EVENT_AGE = Histogram(
+    "event_age_seconds", "Time from the receiver accepting an event to a service handling it",
+    ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+)
+
+def observe_event_age(stage, envelope):
+    """ Records the age of an event from the UTC datetime of its message envelope """
+    try:
+        produced = dt.fromisoformat(envelope["datetime"]).replace(tzinfo=timezone.utc).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return
+    EVENT_AGE.labels(stage).observe(max(time.time() - produced, 0))
+
+def start_lag_monitor(topic, consumer, get_lag, interval_s=15):
+    """
+    Refreshes kafka_consumer_lag every interval_s.
+    get_lag: returns partition ID -> messages left, or None if unknown
+    """
+    def run():
+        while True:
+            lag = get_lag()
+            if lag is not None:
+                for partition_id, value in lag.items():
+                    KAFKA_CONSUMER_LAG.labels(topic, consumer, str(partition_id)).set(value)
+            time.sleep(interval_s)
+
+    t1 = Thread(target=run)
+    t1.setDaemon(True)
+    t1.start()
+
+def setup_multiprocess():
+    """
+    Prepares metrics for forked worker processes: call it before forking.
+    Clears the files of an earlier run, as counters would carry on from them.
+    Raises RuntimeError if PROMETHEUS_MULTIPROC_DIR was not set at startup,
+    the workers' metrics would never reach /metrics.
+    """
+    if not MULTIPROC_DIR:
+        raise RuntimeError("PROMETHEUS_MULTIPROC_DIR must be set to collect metrics from worker processes")
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+    for name in os.listdir(MULTIPROC_DIR):
+        if name.endswith(".db"):
+            os.remove(os.path.join(MULTIPROC_DIR, name))
+
+def render():
+    """ Returns: the metrics in the Prometheus text format """
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+class RouteMatcher:
+    """ Maps request paths to the path templates of an OpenAPI spec """
+    def __init__(self, spec_file, base_path="", extra_paths=()):
+        with open(spec_file, "r") as f:
+            paths = [base_path + path for path in yaml.safe_load(f.read())["paths"]]
+        paths.extend(extra_paths)
+        self.static = {path for path in paths if "{" not in path}
+        self.patterns = [
+            (re.compile("".join(
+                "[^/]+" if part.startswith("{") else re.escape(part)
+                for part in re.split(r"(\{[^}]+\})", path)
+            ) + "$"), path)
+            for path in paths if "{" in path
+        ]
+
+    def match(self, path):
+        """ Returns: the template of the route for path, or UNMATCHED_PATH """
+        if path in self.static:
+            return path
+        for pattern, template in self.patterns:
+            if pattern.match(path):
+                return template
+        return UNMATCHED_PATH
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that times every request and answers /metrics. The path
+    label is the route template from the spec, and every path outside it
+    shares one label, so scans and IDs in paths can't grow the series count.
+    """
+    def __init__(self, app, spec_file, base_path="", extra_paths=()):
+        self.app = app
+        self.routes = RouteMatcher(spec_file, base_path, extra_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["path"] == METRICS_PATH:
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", CONTENT_TYPE_LATEST.encode("utf-8"))],
+            })
+            await send({"type": "http.response.body", "body": render()})
+            return
+
+        status = 500
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUEST_LATENCY.labels(
+                scope["method"], self.routes.match(scope["path"]), str(status)
+            ).observe(time.perf_counter() - start_time)
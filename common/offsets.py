@@ -0,0 +1,24 @@
+"""
+Kafka offset helpers shared by the consumers.
+
+pykafka's reset_offsets takes the last consumed offset, so the next message
+read is the one after it, and commit_offsets takes the next offset to read.
+"""
+from pykafka.common import OffsetType
+
+def seek_offset(offset):
+    """
+    Returns: the value to pass to reset_offsets so the next message read
+    is at offset. Offset 0 has no message before it, and -1 would mean
+    OffsetType.LATEST, so it maps to OffsetType.EARLIEST.
+    """
+    if offset > 0:
+        return offset - 1
+    return OffsetType.EARLIEST
+
+def next_offsets(messages):
+    """ Returns: partition ID -> offset after the last of messages, the offsets to commit """
+    offsets = {}
+    for msg in messages:
+        offsets[msg.partition_id] = max(offsets.get(msg.partition_id, 0), msg.offset + 1)
+    return offsets
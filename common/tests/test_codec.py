@@ -0,0 +1,39 @@
+import json
+import pytest
+from common.codec import CODECS, decode_message, encode_message, get_codec
+
+ENVELOPE = {
+    "type": "donation",
+    "datetime": "2025-01-01T00:00:00.000",
+    "payload": {
+        "event_id": "d290f1ee-6c54-4b01-90e6-d701748f0851",
+        "user_id": "a6b1c9f2-3d4e-4f5a-8b7c-1d2e3f4a5b6c",
+        "amount": 12.5,
+        "currency": "CAD",
+        "message": "Hello chat!",
+        "timestamp": "2025-01-01T00:00:00.000Z",
+    },
+}
+
+@pytest.mark.parametrize("name", list(CODECS))
+def test_round_trip(name):
+    message = encode_message(ENVELOPE, get_codec(name))
+    assert message[0] == CODECS[name].version
+    assert decode_message(message) == ENVELOPE
+
+def test_decodes_legacy_json():
+    assert decode_message(json.dumps(ENVELOPE).encode("utf-8")) == ENVELOPE
+
+def test_unknown_codec_name():
+    with pytest.raises(ValueError):
+        get_codec("avro")
+
+@pytest.mark.parametrize("message", [
+    b"",
+    bytes([99]) + b"{}",
+    b"{not json",
+    bytes([CODECS["msgpack"].version]) + b"\xc1",
+])
+def test_malformed_messages_raise_value_error(message):
+    with pytest.raises(ValueError):
+        decode_message(message)
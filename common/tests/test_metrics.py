@@ -0,0 +1,43 @@
+import pytest
+from common import metrics
+from common.metrics import UNMATCHED_PATH, RouteMatcher
+
+@pytest.fixture
+def routes(tmp_path):
+    spec_file = tmp_path / "spec.yaml"
+    spec_file.write_text(
+        "paths:\n"
+        "  /stats: {}\n"
+        "  /stream/{event_type}/{index}: {}\n"
+    )
+    return RouteMatcher(str(spec_file), "/analyzer", ["/analyzer/dashboard/stream"])
+
+def test_static_paths(routes):
+    assert routes.match("/analyzer/stats") == "/analyzer/stats"
+    assert routes.match("/analyzer/dashboard/stream") == "/analyzer/dashboard/stream"
+
+def test_templated_paths(routes):
+    assert routes.match("/analyzer/stream/chat/12") == "/analyzer/stream/{event_type}/{index}"
+
+@pytest.mark.parametrize("path", [
+    "/analyzer/stats/extra",
+    "/analyzer/stream/chat",
+    "/analyzer/stream/chat/12/13",
+    "/wp-login.php",
+])
+def test_unknown_paths_share_one_label(routes, path):
+    assert routes.match(path) == UNMATCHED_PATH
+
+def test_setup_multiprocess_needs_the_directory(monkeypatch):
+    monkeypatch.setattr(metrics, "MULTIPROC_DIR", None)
+    with pytest.raises(RuntimeError):
+        metrics.setup_multiprocess()
+
+def test_setup_multiprocess_clears_earlier_runs(monkeypatch, tmp_path):
+    (tmp_path / "counter_123.db").write_bytes(b"")
+    (tmp_path / "notes.txt").write_text("kept")
+    monkeypatch.setattr(metrics, "MULTIPROC_DIR", str(tmp_path / "prometheus"))
+    metrics.setup_multiprocess()
+    monkeypatch.setattr(metrics, "MULTIPROC_DIR", str(tmp_path))
+    metrics.setup_multiprocess()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["notes.txt", "prometheus"]
@@ -0,0 +1,22 @@
+from types import SimpleNamespace
+from pykafka.common import OffsetType
+from common.offsets import next_offsets, seek_offset
+
+def message(partition_id, offset):
+    return SimpleNamespace(partition_id=partition_id, offset=offset)
+
+def test_seek_offset_reads_from_offset():
+    # reset_offsets takes the last consumed offset
+    assert seek_offset(10) == 9
+    assert seek_offset(1) == 0
+
+def test_seek_offset_zero_is_earliest():
+    # -1 would be OffsetType.LATEST and skip the whole partition
+    assert seek_offset(0) == OffsetType.EARLIEST
+
+def test_next_offsets_are_after_the_last_message():
+    batch = [message(0, 5), message(1, 0), message(0, 7), message(0, 6)]
+    assert next_offsets(batch) == {0: 8, 1: 1}
+
+def test_next_offsets_of_empty_batch():
+    assert next_offsets([]) == {}
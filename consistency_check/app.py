@@ -6,7 +6,12 @@ import uuid
 import httpx
 import yaml
 import json
+import hashlib
 from datetime import datetime as dt, timezone
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from common.metrics import MetricsMiddleware
+from connexion.middleware import MiddlewarePosition
 import os
 
 # Get environment
@@ -26,65 +31,410 @@ DATA_FILE = app_config["datastore"]["filename"]
 PROCESSING_URL = app_config['processing']['url']
 ANALYZER_URL = app_config['analyzer']['url']
 STORAGE_URL = app_config['storage']['url']
+CHECK_MODE = app_config.get("checks", {}).get("mode", "ids")
+CHECK_PARTITIONS = app_config.get("checks", {}).get("partitions", 1)
+CHECK_BUCKETS = app_config.get("checks", {}).get("buckets", 256)
+CHECK_INCREMENTAL = app_config.get("checks", {}).get("incremental", False)
+CHECKPOINT_FILE = app_config.get("checks", {}).get("checkpoint_file", "data/consistency_check_checkpoint.json")
+CHECKPOINT_VERSION = 2
+EVENT_TYPES = ["chat", "donation"]
 
-def request(method, url):
+REQUEST_TIMEOUT_S = app_config.get("requests", {}).get("timeout_s", 10)
+REQUEST_RETRIES = app_config.get("requests", {}).get("retries", 2)
+REQUEST_WORKERS = app_config.get("requests", {}).get("workers", 8)
+
+# Shared keep-alive connections. Retries are done by request() only, so a
+# failing call is tried REQUEST_RETRIES + 1 times in total.
+http_client = httpx.Client(
+    timeout=REQUEST_TIMEOUT_S,
+    limits=httpx.Limits(max_connections=REQUEST_WORKERS * 2, max_keepalive_connections=REQUEST_WORKERS),
+)
+executor = ThreadPoolExecutor(max_workers=REQUEST_WORKERS)
+check_lock = Lock()
+
+class Latencies:
+    """ Per-dependency call counts and latencies of one check run """
+    def __init__(self):
+        self.lock = Lock()
+        self.dependencies = {}
+
+    def add(self, name, latency_ms, ok):
+        with self.lock:
+            dependency = self.dependencies.setdefault(name, {"calls": 0, "failures": 0, "total_ms": 0, "max_ms": 0})
+            dependency["calls"] += 1
+            dependency["failures"] += 0 if ok else 1
+            dependency["total_ms"] += latency_ms
+            dependency["max_ms"] = max(dependency["max_ms"], latency_ms)
+
+def request(method, url, params=None, name=None, latencies=None):
+    """
+    Makes a request through the shared client, retrying timeouts and 5xx responses.
+    Returns: the decoded JSON body, or None (failure)
+    """
     event_data = None
-    response = httpx.request(method, url)
-    if response.status_code != 200:
-        logger.error(f"Request for {url} events failed: {response.status_code}")
+    start_time = time.time()
+    for attempt in range(REQUEST_RETRIES + 1):
+        try:
+            response = http_client.request(method, url, params=params)
+        except httpx.HTTPError as e:
+            logger.warning(f"Request for {url} failed (attempt {attempt + 1}): {e}")
+            continue
+        if response.status_code >= 500:
+            logger.warning(f"Request for {url} failed (attempt {attempt + 1}): {response.status_code}")
+            continue
+        if response.status_code != 200:
+            logger.error(f"Request for {url} events failed: {response.status_code}")
+        else:
+            event_data = json.loads(response.content.decode("utf-8"))
+            logger.info(f"Request for {url} was successful")
+        break
     else:
-        event_data = json.loads(response.content.decode("utf-8"))
-        logger.info(f"Request for {url} was successful")
+        logger.error(f"Request for {url} failed after {REQUEST_RETRIES + 1} attempts")
+    if latencies is not None:
+        latency_ms = int((time.time() - start_time) * 1000)
+        latencies.add(name or url, latency_ms, event_data is not None)
     return event_data
 
-def run_consistency_checks():
+def request_all(calls, latencies=None):
+    """
+    Runs requests concurrently on the shared executor.
+    calls: name -> (method, url, params)
+    Returns: name -> decoded JSON body or None
+    """
+    futures = {
+        name: executor.submit(request, method, url, params, name, latencies)
+        for name, (method, url, params) in calls.items()
+    }
+    return {name: future.result() for name, future in futures.items()}
+
+def id_ranges(partitions):
+    """ Splits the hex event ID space into (start_id, end_id) ranges """
+    if partitions <= 1:
+        return [(None, None)]
+    bounds = [f"{i * 16**8 // partitions:08x}" for i in range(1, partitions)]
+    return list(zip([None] + bounds, bounds + [None]))
+
+def diff_event_ids(queue_event_ids, db_event_ids):
+    """
+    Compares event IDs by hashing (event_id, trace_id) pairs, in O(n+m).
+    Returns: (not_in_db, not_in_queue)
+    """
+    queue_keys = {(event["event_id"], event["trace_id"]) for event in queue_event_ids}
+    db_keys = {(event["event_id"], event["trace_id"]) for event in db_event_ids}
+    not_in_db = [event for event in queue_event_ids if (event["event_id"], event["trace_id"]) not in db_keys]
+    not_in_queue = [event for event in db_event_ids if (event["event_id"], event["trace_id"]) not in queue_keys]
+    return not_in_db, not_in_queue
+
+def compare_event_ids(latencies=None):
+    """
+    Diffs analyzer and storage event IDs one ID range at a time,
+    so only one range of IDs is held in memory.
+    Returns: event type -> (not_in_db, not_in_queue)
+    """
+    result = {event_type: ([], []) for event_type in EVENT_TYPES}
+    for start_id, end_id in id_ranges(CHECK_PARTITIONS):
+        params = {}
+        if start_id is not None:
+            params["start_id"] = start_id
+        if end_id is not None:
+            params["end_id"] = end_id
+        results = request_all({
+            f"{service}_event_ids_{event_type}": ("GET", f"{url}/event_ids/{event_type}", params)
+            for service, url in [("analyzer", ANALYZER_URL), ("storage", STORAGE_URL)]
+            for event_type in EVENT_TYPES
+        }, latencies)
+        for event_type in EVENT_TYPES:
+            range_not_in_db, range_not_in_queue = diff_event_ids(
+                results[f"analyzer_event_ids_{event_type}"] or [],
+                results[f"storage_event_ids_{event_type}"] or []
+            )
+            result[event_type][0].extend(range_not_in_db)
+            result[event_type][1].extend(range_not_in_queue)
+    return result
+
+def mismatched_buckets(queue_digest, db_digest):
+    """
+    Compares the analyzer and storage digests of an event type.
+    Returns: buckets whose count or hash differ, or None if a digest is unavailable
+    """
+    if queue_digest is None or db_digest is None:
+        return None
+    queue_buckets = {d["bucket"]: (d["count"], d["digest"]) for d in queue_digest["digests"]}
+    db_buckets = {d["bucket"]: (d["count"], d["digest"]) for d in db_digest["digests"]}
+    return sorted(
+        bucket for bucket in queue_buckets.keys() | db_buckets.keys()
+        if queue_buckets.get(bucket) != db_buckets.get(bucket)
+    )
+
+def compare_digests(latencies=None):
+    """
+    Compares per-bucket digests and only fetches the event IDs of buckets
+    that disagree, so a consistent check transfers no event IDs.
+    Returns: event type -> (not_in_db, not_in_queue), or None if a digest is unavailable
+    """
+    params = {"buckets": CHECK_BUCKETS}
+    digests = request_all({
+        f"{service}_digest_{event_type}": ("GET", f"{url}/digest/{event_type}", params)
+        for service, url in [("analyzer", ANALYZER_URL), ("storage", STORAGE_URL)]
+        for event_type in EVENT_TYPES
+    }, latencies)
+
+    result = {}
+    for event_type in EVENT_TYPES:
+        buckets = mismatched_buckets(digests[f"analyzer_digest_{event_type}"], digests[f"storage_digest_{event_type}"])
+        if buckets is None:
+            return None
+        logger.info(f"{len(buckets)} of {CHECK_BUCKETS} {event_type} digest buckets differ")
+        not_in_db = []
+        not_in_queue = []
+        for bucket in buckets:
+            params = {"bucket": bucket, "buckets": CHECK_BUCKETS}
+            results = request_all({
+                f"analyzer_event_ids_{event_type}": ("GET", f"{ANALYZER_URL}/event_ids/{event_type}", params),
+                f"storage_event_ids_{event_type}": ("GET", f"{STORAGE_URL}/event_ids/{event_type}", params),
+            }, latencies)
+            analyzer_event_ids = results[f"analyzer_event_ids_{event_type}"] or []
+            storage_event_ids = results[f"storage_event_ids_{event_type}"] or []
+            bucket_not_in_db, bucket_not_in_queue = diff_event_ids(analyzer_event_ids, storage_event_ids)
+            not_in_db.extend(bucket_not_in_db)
+            not_in_queue.extend(bucket_not_in_queue)
+        result[event_type] = (not_in_db, not_in_queue)
+    return result
+
+def id_bucket(event_id, buckets):
+    """ Bucket of an event: first 32 bits of MD5(event_id) modulo buckets, as in analyzer and storage """
+    return int(hashlib.md5(event_id.encode("utf-8")).hexdigest()[:8], 16) % buckets
+
+def unique_event_ids(event_ids):
+    """ Drops repeated (event_id, trace_id) pairs, keeping the first """
+    seen = set()
+    unique = []
+    for event in event_ids:
+        key = (event["event_id"], event["trace_id"])
+        if key not in seen:
+            seen.add(key)
+            unique.append({"event_id": event["event_id"], "trace_id": event["trace_id"]})
+    return unique
+
+def reverify(event_type, missing, url, name, latencies=None):
+    """
+    Re-checks carried missing events against one side, fetching only the
+    buckets they fall in. Catches rows the new ranges skipped.
+    Returns: the events that are still missing, or None (failure)
+    """
+    if not missing:
+        return []
+    buckets = sorted({id_bucket(event["event_id"], CHECK_BUCKETS) for event in missing})
+    futures = [
+        executor.submit(
+            request, "GET", f"{url}/event_ids/{event_type}",
+            {"bucket": bucket, "buckets": CHECK_BUCKETS}, name, latencies
+        )
+        for bucket in buckets
+    ]
+    found = set()
+    for future in futures:
+        event_ids = future.result()
+        if event_ids is None:
+            return None
+        found.update((event["event_id"], event["trace_id"]) for event in event_ids)
+    return [event for event in missing if (event["event_id"], event["trace_id"]) not in found]
+
+def load_checkpoint():
+    """ Reads the last checkpoint, None if there is none or it is from another format """
+    try:
+        with open(CHECKPOINT_FILE, "r") as fd:
+            checkpoint = json.load(fd)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        logger.warning(f"Ignoring checkpoint with version {checkpoint.get('version')}")
+        return None
+    return checkpoint
+
+def save_checkpoint(checkpoint):
+    """ Writes the checkpoint to a temp file then renames it, so a crash never leaves half a file """
+    checkpoint["version"] = CHECKPOINT_VERSION
+    tmp_file = f"{CHECKPOINT_FILE}.tmp"
+    with open(tmp_file, "w") as fd:
+        json.dump(checkpoint, fd)
+    os.replace(tmp_file, CHECKPOINT_FILE)
+
+def format_offsets(offsets):
+    """ Formats partition ID -> offset as the analyzer's start_offsets, "partition:offset,..." """
+    pairs = sorted((int(partition_id), offset) for partition_id, offset in offsets.items())
+    # Partitions left out start at 0, so "0:0" stands for an empty topic
+    return ",".join(f"{partition_id}:{offset}" for partition_id, offset in pairs) or "0:0"
+
+def compare_incremental(checkpoint, latencies=None):
+    """
+    Diffs only events added since the checkpoint: queue events from the next
+    offset of each partition and DB rows after the last row ID. Events still missing
+    from the previous run are carried into the diff, and the ones still
+    missing afterwards are re-verified against their digest buckets.
+    Returns: (event type -> (not_in_db, not_in_queue), new checkpoint), or None (failure)
+    """
+    results = request_all({
+        f"{service}_event_ids_{event_type}": ("GET", f"{url}/event_ids/{event_type}", params)
+        for event_type in EVENT_TYPES
+        for service, url, params in [
+            ("analyzer", ANALYZER_URL, {"start_offsets": format_offsets(checkpoint["queue_offsets"][event_type])}),
+            ("storage", STORAGE_URL, {"after_id": checkpoint["db_last_ids"][event_type]}),
+        ]
+    }, latencies)
+    if any(event_ids is None for event_ids in results.values()):
+        return None
+
+    result = {}
+    new_checkpoint = {"queue_offsets": {}, "db_last_ids": {}, "not_in_db": {}, "not_in_queue": {}}
+    for event_type in EVENT_TYPES:
+        queue_new = results[f"analyzer_event_ids_{event_type}"]
+        db_new = results[f"storage_event_ids_{event_type}"]
+        carried_not_in_db = checkpoint["not_in_db"][event_type]
+        carried_not_in_queue = checkpoint["not_in_queue"][event_type]
+        logger.info(f"{len(queue_new)} new queue and {len(db_new)} new DB {event_type} events since checkpoint")
+
+        not_in_db, not_in_queue = diff_event_ids(
+            unique_event_ids(carried_not_in_db + queue_new),
+            unique_event_ids(carried_not_in_queue + db_new)
+        )
+
+        # Only events carried from the last run are looked up again
+        carried_keys = {(event["event_id"], event["trace_id"]) for event in carried_not_in_db + carried_not_in_queue}
+        recheck_db = [event for event in not_in_db if (event["event_id"], event["trace_id"]) in carried_keys]
+        recheck_queue = [event for event in not_in_queue if (event["event_id"], event["trace_id"]) in carried_keys]
+        still_not_in_db = reverify(event_type, recheck_db, STORAGE_URL, f"storage_recheck_{event_type}", latencies)
+        still_not_in_queue = reverify(event_type, recheck_queue, ANALYZER_URL, f"analyzer_recheck_{event_type}", latencies)
+        if still_not_in_db is None or still_not_in_queue is None:
+            return None
+        resolved = {
+            (event["event_id"], event["trace_id"])
+            for event in recheck_db + recheck_queue
+        } - {
+            (event["event_id"], event["trace_id"])
+            for event in still_not_in_db + still_not_in_queue
+        }
+        not_in_db = [event for event in not_in_db if (event["event_id"], event["trace_id"]) not in resolved]
+        not_in_queue = [event for event in not_in_queue if (event["event_id"], event["trace_id"]) not in resolved]
+
+        result[event_type] = (not_in_db, not_in_queue)
+        queue_offsets = dict(checkpoint["queue_offsets"][event_type])
+        for event in queue_new:
+            partition_id = str(event["partition"])
+            queue_offsets[partition_id] = max(queue_offsets.get(partition_id, 0), event["offset"] + 1)
+        new_checkpoint["queue_offsets"][event_type] = queue_offsets
+        new_checkpoint["db_last_ids"][event_type] = max(
+            [checkpoint["db_last_ids"][event_type]] + [event["id"] for event in db_new]
+        )
+        new_checkpoint["not_in_db"][event_type] = not_in_db
+        new_checkpoint["not_in_queue"][event_type] = not_in_queue
+    return result, new_checkpoint
+
+def compare_full(analyzer_stats, storage_stats, latencies=None):
+    """
+    Compares every event, falling back to full event ID lists if digests are unavailable.
+    The checkpoint offsets are taken from counts fetched before the compare,
+    so events added during the compare are diffed again on the next run.
+    Returns: (event type -> (not_in_db, not_in_queue), new checkpoint)
+    """
+    result = compare_digests(latencies) if CHECK_MODE == "digest" else None
+    if result is None:
+        result = compare_event_ids(latencies)
+
+    new_checkpoint = None
+    if analyzer_stats and "offsets" in analyzer_stats and "max_chat_id" in storage_stats:
+        new_checkpoint = {
+            "queue_offsets": {
+                "chat": analyzer_stats["offsets"],
+                "donation": analyzer_stats["offsets"],
+            },
+            "db_last_ids": {
+                "chat": storage_stats["max_chat_id"],
+                "donation": storage_stats["max_donation_id"],
+            },
+            "not_in_db": {event_type: result[event_type][0] for event_type in EVENT_TYPES},
+            "not_in_queue": {event_type: result[event_type][1] for event_type in EVENT_TYPES},
+            "last_full_sweep": dt.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+        }
+    return result, new_checkpoint
+
+def run_consistency_checks(full=False):
+    # Runs share the checkpoint, so they must not overlap
+    with check_lock:
+        return run_checks(full)
+
+def run_checks(full):
     start_time = time.time()
     logger.info("Starting consistency checks")
+    latencies = Latencies()
+
+    # Counts are fetched while the incremental diff runs. A full sweep
+    # needs the analyzer and storage counts first to pin its range.
+    counts = {
+        name: executor.submit(request, "GET", url, None, name, latencies)
+        for name, url in [
+            ("processing_stats", f"{PROCESSING_URL}/stats"),
+            ("analyzer_stats", f"{ANALYZER_URL}/stats"),
+            ("storage_count", f"{STORAGE_URL}/count"),
+        ]
+    }
+    checkpoint = None if full or not CHECK_INCREMENTAL else load_checkpoint()
+    incremental = compare_incremental(checkpoint, latencies) if checkpoint is not None else None
+    analyzer_stats = counts["analyzer_stats"].result()
+    storage_stats = counts["storage_count"].result() or {}
+    if incremental is not None:
+        result, new_checkpoint = incremental
+        new_checkpoint["last_full_sweep"] = checkpoint.get("last_full_sweep")
+        full_sweep = False
+    else:
+        if checkpoint is not None:
+            logger.warning("Incremental check failed, running a full sweep")
+        result, new_checkpoint = compare_full(analyzer_stats, storage_stats, latencies)
+        full_sweep = True
+    if CHECK_INCREMENTAL and new_checkpoint is not None:
+        save_checkpoint(new_checkpoint)
+
+    not_in_db = [event for event_type in EVENT_TYPES for event in result[event_type][0]]
+    not_in_queue = [event for event_type in EVENT_TYPES for event in result[event_type][1]]
 
-    processing_stats = request("GET", f"{PROCESSING_URL}/stats")
-    analyzer_stats = request("GET", f"{ANALYZER_URL}/stats")
-    analyzer_chat_event_ids = request("GET", f"{ANALYZER_URL}/event_ids/chat") or []
-    analyzer_donation_event_ids = request("GET", f"{ANALYZER_URL}/event_ids/donation") or []
-    storage_stats = request("GET", f"{STORAGE_URL}/count")
-    storage_chat_event_ids = request("GET", f"{STORAGE_URL}/event_ids/chat") or []
-    storage_donation_event_ids = request("GET", f"{STORAGE_URL}/event_ids/donation") or []
+    processing_stats = counts["processing_stats"].result()
 
     # process counts
+    db_count = {
+        key: value for key, value in storage_stats.items()
+        if key in ("chat_count", "donation_count")
+    }
     queue_count = {
         "chat_count": analyzer_stats["num_chats"],
         "donation_count": analyzer_stats["num_donations"],
-    }
+    } if analyzer_stats else {}
     processing_count = {
         "chat_count": processing_stats["num_chats"],
         "donation_count": processing_stats["num_donations"],
-    }
-
-    # compare
-    analyzer_event_ids = analyzer_chat_event_ids + analyzer_donation_event_ids
-    storage_event_ids = storage_chat_event_ids + storage_donation_event_ids
-    not_in_db = [event for event in analyzer_event_ids if event not in storage_event_ids]
-    not_in_queue = [event for event in storage_event_ids if event not in analyzer_event_ids]
+    } if processing_stats else {}
 
     # write data
     last_updated = dt.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
     data = {
         "last_updated": last_updated,
+        "full_sweep": full_sweep,
         "counts": {
-            "db": storage_stats,
+            "db": db_count,
             "queue": queue_count,
             "processing": processing_count,
         },
         "not_in_db": not_in_db,
-        "not_in_queue": not_in_queue
+        "not_in_queue": not_in_queue,
+        "dependencies": latencies.dependencies
     }
 
     with open(DATA_FILE, "w") as fd:
         json.dump(data, fd, indent=4)
 
     processing_time_ms = int((time.time() - start_time) * 1000)
-    logger.info(f"Consistency checks completed | processing_time_ms={processing_time_ms} | missing_in_db={len(not_in_db)} | missing_in_queue={len(not_in_queue)}")
+    logger.info(f"Consistency checks completed | full_sweep={full_sweep} | processing_time_ms={processing_time_ms} | missing_in_db={len(not_in_db)} | missing_in_queue={len(not_in_queue)}")
 
-    return {"processing_time_ms": processing_time_ms}
+    return {"processing_time_ms": processing_time_ms, "full_sweep": full_sweep}
 
 def get_checks():
     logger.info("Received check request")
@@ -99,6 +449,12 @@ def get_checks():
 
 app = connexion.FlaskApp(__name__, specification_dir='')
 app.add_api("consistency_check.yaml", base_path="/consistency_check", strict_validation=True, validate_responses=True)
+app.add_middleware(
+    MetricsMiddleware,
+    position=MiddlewarePosition.BEFORE_EXCEPTION,
+    spec_file="consistency_check.yaml",
+    base_path="/consistency_check",
+)
 
 if __name__ == "__main__":
     app.run(port=8120, host="0.0.0.0")
\ No newline at end of file
@@ -1,15 +1,17 @@
 /* UPDATE THESE VALUES TO MATCH YOUR SETUP */
 
 const VM_URL = "VM_URL_PLACEHOLDER";
-const PROCESSING_STATS_API_URL = `http://${VM_URL}/processing/stats`;
-const CHECK_API_URL = `http://${VM_URL}/consistency_check/checks`;
+const DASHBOARD_API_URL = `http://${VM_URL}/processing/dashboard`;
+const DASHBOARD_STREAM_URL = `http://${VM_URL}/processing/dashboard/stream`;
 const UPDATE_API_URL = `http://${VM_URL}/consistency_check/update`;
 
-const getRandomIndex = () => Math.floor(Math.random() * 10);
-const ANALYZER_API_URL = {
-    stats: `http://${VM_URL}/analyzer/stats`,
-    chat: `http://${VM_URL}/analyzer/stream/chats?index=${getRandomIndex()}`,
-    donation: `http://${VM_URL}/analyzer/stream/donations?index=${getRandomIndex()}`
+// Snapshot section -> element it is shown in
+const SECTIONS = {
+    processing: "processing-stats",
+    analyzer: "analyzer-stats",
+    chat: "event-chat",
+    donation: "event-donation",
+    check: "check"
 }
 
 // This function fetches and updates the general statistics
@@ -28,14 +30,26 @@ const updateCodeDiv = (result, elemId) => document.getElementById(elemId).innerT
 
 const getLocaleDateStr = () => (new Date()).toLocaleString()
 
-const getStats = () => {
+// Shows the sections present in a snapshot or delta, others are left as they are
+const updateSections = (snapshot) => {
     document.getElementById("last-updated-value").innerText = getLocaleDateStr()
-    
-    makeReq(PROCESSING_STATS_API_URL, (result) => updateCodeDiv(result, "processing-stats"))
-    makeReq(ANALYZER_API_URL.stats, (result) => updateCodeDiv(result, "analyzer-stats"))
-    makeReq(ANALYZER_API_URL.chat, (result) => updateCodeDiv(result, "event-chat"))
-    makeReq(ANALYZER_API_URL.donation, (result) => updateCodeDiv(result, "event-donation"))
-    makeReq(CHECK_API_URL, (result) => updateCodeDiv(result, "check"))
+
+    for (const [section, elemId] of Object.entries(SECTIONS)) {
+        if (section in snapshot) {
+            updateCodeDiv(snapshot[section], elemId)
+        }
+    }
+}
+
+const getStats = () => makeReq(DASHBOARD_API_URL, updateSections)
+
+// The server pushes the whole snapshot first, then only what changed.
+// Falls back to polling the snapshot if the browser has no EventSource.
+const subscribe = () => {
+    const source = new EventSource(DASHBOARD_STREAM_URL)
+    source.addEventListener("snapshot", (event) => updateSections(JSON.parse(event.data)))
+    source.addEventListener("delta", (event) => updateSections(JSON.parse(event.data)))
+    source.onerror = () => updateErrorMessages("Lost connection to the dashboard stream, reconnecting")
 }
 
 const updateErrorMessages = (message) => {
@@ -53,8 +67,12 @@ const updateErrorMessages = (message) => {
 }
 
 const setup = () => {
-    getStats()
-    setInterval(() => getStats(), 4000) // Update every 4 seconds
+    if (window.EventSource) {
+        subscribe()
+    } else {
+        getStats()
+        setInterval(() => getStats(), 4000) // Update every 4 seconds
+    }
 }
 
 document.addEventListener('DOMContentLoaded', setup)
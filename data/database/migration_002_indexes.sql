@@ -0,0 +1,53 @@
+-- Migration 002: secondary indexes, unique event IDs and DATETIME event timestamps
+-- Runs after create_tables.sql on a fresh database. To apply to an existing one:
+--   docker compose exec -T db sh -c 'mysql -u"$MYSQL_USER" -p"$MYSQL_PASSWORD" livestream' < data/database/migration_002_indexes.sql
+
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INT PRIMARY KEY,
+    applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- Keep the first copy of each redelivered event so event_id can be unique
+DELETE c1 FROM chat c1 JOIN chat c2 ON c1.event_id = c2.event_id AND c1.id > c2.id;
+DELETE d1 FROM donation d1 JOIN donation d2 ON d1.event_id = d2.event_id AND d1.id > d2.id;
+
+-- Event timestamps are stored as RFC 3339 strings, e.g. 2016-08-29T09:12:33.001Z
+-- or 2016-08-29T05:12:33-04:00, and become UTC like storage's parse_timestamp.
+-- CONVERT_TZ takes numeric offsets without the time zone tables. A row that
+-- doesn't parse stays NULL, so the NOT NULL change stops the migration and
+-- the row can be fixed by hand before running it again.
+ALTER TABLE chat ADD COLUMN timestamp_dt DATETIME(3) NULL AFTER reaction_count;
+UPDATE chat SET timestamp_dt = CONVERT_TZ(
+    STR_TO_DATE(REGEXP_SUBSTR(timestamp, '^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}([.][0-9]+)?'), '%Y-%m-%dT%H:%i:%s.%f'),
+    COALESCE(REGEXP_SUBSTR(timestamp, '[+-][0-9]{2}:[0-9]{2}$'), '+00:00'),
+    '+00:00'
+);
+ALTER TABLE chat
+    DROP COLUMN timestamp,
+    CHANGE COLUMN timestamp_dt timestamp DATETIME(3) NOT NULL;
+
+ALTER TABLE donation ADD COLUMN timestamp_dt DATETIME(3) NULL AFTER message;
+UPDATE donation SET timestamp_dt = CONVERT_TZ(
+    STR_TO_DATE(REGEXP_SUBSTR(timestamp, '^[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}([.][0-9]+)?'), '%Y-%m-%dT%H:%i:%s.%f'),
+    COALESCE(REGEXP_SUBSTR(timestamp, '[+-][0-9]{2}:[0-9]{2}$'), '+00:00'),
+    '+00:00'
+);
+ALTER TABLE donation
+    DROP COLUMN timestamp,
+    CHANGE COLUMN timestamp_dt timestamp DATETIME(3) NOT NULL;
+
+-- InnoDB secondary indexes include the primary key, so date_created
+-- also serves the (date_created, id) keyset pagination order
+ALTER TABLE chat
+    ADD UNIQUE INDEX ux_chat_event_id (event_id),
+    ADD INDEX ix_chat_date_created (date_created),
+    ADD INDEX ix_chat_trace_id (trace_id),
+    ADD INDEX ix_chat_user_id (user_id);
+
+ALTER TABLE donation
+    ADD UNIQUE INDEX ux_donation_event_id (event_id),
+    ADD INDEX ix_donation_date_created (date_created),
+    ADD INDEX ix_donation_trace_id (trace_id),
+    ADD INDEX ix_donation_user_id (user_id);
+
+INSERT INTO schema_version (version) VALUES (2);
@@ -0,0 +1,34 @@
+-- Checks that the storage queries use the indexes from migration 002 in MySQL,
+-- storage/tests/test_indexes.py checks the same in SQLite on every test run. Not in
+-- data/database, so it doesn't run on a fresh database. Run it with:
+--   docker compose exec -T db sh -c 'mysql -u"$MYSQL_USER" -p"$MYSQL_PASSWORD" livestream' < data/explain_002_indexes.sql
+-- Each EXPLAIN should show the index named above it in the key column, and
+-- no "Using filesort" for the pages. On a nearly empty table MySQL may pick a
+-- full scan, so check against a database with some events in it.
+
+-- GET /storage/chats and /storage/donations with limit: key ix_*_date_created
+EXPLAIN SELECT * FROM chat
+    WHERE date_created >= '2025-01-01 00:00:00' AND date_created < '2025-01-02 00:00:00'
+    ORDER BY date_created, id LIMIT 101;
+EXPLAIN SELECT * FROM donation
+    WHERE date_created >= '2025-01-01 00:00:00' AND date_created < '2025-01-02 00:00:00'
+    ORDER BY date_created, id LIMIT 101;
+
+-- The same pages after a keyset cursor: key ix_*_date_created
+EXPLAIN SELECT * FROM chat
+    WHERE date_created >= '2025-01-01 00:00:00' AND date_created < '2025-01-02 00:00:00'
+    AND (date_created, id) > ('2025-01-01 12:00:00', 1000)
+    ORDER BY date_created, id LIMIT 101;
+
+-- GET /storage/event_ids/* in an event ID range: key ux_*_event_id
+EXPLAIN SELECT event_id, trace_id FROM chat
+    WHERE event_id >= '00000000' AND event_id < '80000000';
+EXPLAIN SELECT event_id, trace_id FROM donation
+    WHERE event_id >= '00000000' AND event_id < '80000000';
+
+-- A redelivered event hitting the unique event ID: key ux_*_event_id
+EXPLAIN SELECT id FROM chat WHERE event_id = '00000000-0000-0000-0000-000000000000';
+
+-- Lookups by trace and user: key ix_*_trace_id, ix_*_user_id
+EXPLAIN SELECT * FROM chat WHERE trace_id = '00000000-0000-0000-0000-000000000000';
+EXPLAIN SELECT * FROM donation WHERE user_id = '00000000-0000-0000-0000-000000000000';
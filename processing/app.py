@@ -1,13 +1,25 @@
 import logging.config
 import connexion
+from connexion import NoContent, request
 import httpx
+import time
+import random
 import yaml
 import logging.config
 from apscheduler.schedulers.background import BackgroundScheduler
 import json
-from datetime import datetime as dt, timezone
+import asyncio
+import sqlite3
+import hashlib
+from datetime import datetime as dt, timedelta, timezone
+from threading import Thread, Lock
+from pykafka import KafkaClient
+from pykafka.exceptions import KafkaException
+from pykafka.common import OffsetType
 import os
 from connexion.middleware import MiddlewarePosition
+from common.codec import decode_message
+from common.metrics import DB_LATENCY, KAFKA_CONSUMED, MetricsMiddleware, observe_event_age, start_lag_monitor
 from starlette.middleware.cors import CORSMiddleware
 
 # Get environment
@@ -23,31 +35,400 @@ with open(f'config/app_conf.{ENVIRONMENT}.yml', 'r') as f:
     app_config = yaml.safe_load(f.read())
 
 DATA_FILE = app_config["datastore"]["filename"]
+STATS_MODE = app_config.get("stats", {}).get("mode", "stream")
+PAGE_SIZE = app_config.get("stats", {}).get("page_size", 1000)
+
+ROLLUPS_ENABLED = app_config.get("rollups", {}).get("enabled", False)
+ROLLUPS_FILE = app_config.get("rollups", {}).get("filename", "data/processing_rollups.db")
+ROLLUPS_TOP_K = app_config.get("rollups", {}).get("top_k", 100)
+ROLLUPS_RETENTION_DAYS = app_config.get("rollups", {}).get("retention_days", {"minute": 2, "hour": 90, "top_users": 30})
+
+# Kafka mode counts from the topic offsets in its own snapshot. Sharing the
+# files of the other modes would count the events already in them again.
+if STATS_MODE == "kafka":
+    DATA_FILE = "{}_kafka{}".format(*os.path.splitext(DATA_FILE))
+    ROLLUPS_FILE = "{}_kafka{}".format(*os.path.splitext(ROLLUPS_FILE))
+
+KAFKA_HOST = app_config.get("kafka", {}).get("events", {}).get("hostname")
+KAFKA_PORT = app_config.get("kafka", {}).get("events", {}).get("port")
+KAFKA_TOPIC = app_config.get("kafka", {}).get("events", {}).get("topic")
+KAFKA_CONSUMER_GROUP = app_config.get("kafka", {}).get("consumer_group", "processing_group")
+KAFKA_CONSUMER_TIMEOUT_MS = app_config.get("kafka", {}).get("consumer_timeout_ms", 1000)
+KAFKA_FLUSH_INTERVAL_S = app_config.get("kafka", {}).get("flush_interval_s", 5)
+
+SCHEDULER_MODE = app_config["scheduler"].get("mode", "fixed")
+SCHEDULER_INTERVAL = app_config["scheduler"]["interval"]
+SCHEDULER_MIN_INTERVAL = app_config["scheduler"].get("min_interval", 0)
+SCHEDULER_MAX_INTERVAL = app_config["scheduler"].get("max_interval", 60)
+SCHEDULER_MAX_WINDOW_S = app_config["scheduler"].get("max_window_s", 3600)
+
+DASHBOARD_ENABLED = app_config.get("dashboard", {}).get("enabled", False)
+DASHBOARD_REFRESH_INTERVAL_S = app_config.get("dashboard", {}).get("refresh_interval_s", 4)
+DASHBOARD_ANALYZER_URL = app_config.get("dashboard", {}).get("analyzer_url")
+DASHBOARD_CHECK_URL = app_config.get("dashboard", {}).get("check_url")
+DASHBOARD_STREAM_PATH = "/processing/dashboard/stream"
+DASHBOARD_HEARTBEAT_S = 15
+
+STATS_FORMAT_VERSION = 1
+STATS_KEYS = {"num_chats", "total_chat_reactions", "num_donations", "total_donations"}
+
+# Heavy hitters are ranked by number of chats and by amount donated
+TOP_USERS_METRIC = {"chat": "count", "donation": "sum"}
 
 logger = logging.getLogger('basicLogger')
 
+class Rollups:
+    """
+    Tumbling-window rollups in SQLite: count/sum per event type per minute and hour,
+    and a bounded top-K sketch of users per event type per day (Space-Saving).
+    Windows are only folded in once, tracked by the end of the last window added.
+    """
+    def __init__(self, filename, top_k):
+        self.top_k = top_k
+        self.lock = Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    event_type TEXT NOT NULL,
+                    resolution TEXT NOT NULL,
+                    bucket TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    sum REAL NOT NULL,
+                    PRIMARY KEY (event_type, resolution, bucket)
+                ) WITHOUT ROWID
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS top_users (
+                    event_type TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    sum REAL NOT NULL,
+                    error REAL NOT NULL,
+                    PRIMARY KEY (event_type, day, user_id)
+                ) WITHOUT ROWID
+            """)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS watermark (id INTEGER PRIMARY KEY CHECK (id = 0), end_timestamp TEXT NOT NULL)")
+
+    def add_window(self, end_timestamp, rollup):
+        """
+        Folds the rollup of one window into the buckets and sketches.
+        rollup: event type -> {"minutes": {minute: [count, sum]}, "users": {(day, user_id): [count, sum]}}
+        Returns: True (added), False (window was already added)
+        """
+        with self.lock, self.conn, DB_LATENCY.labels("rollups_add_window").time():
+            row = self.conn.execute("SELECT end_timestamp FROM watermark").fetchone()
+            if row is not None and row[0] >= end_timestamp:
+                return False
+            for event_type, window in rollup.items():
+                for minute, (count, total) in window["minutes"].items():
+                    for resolution, bucket in [
+                        ("minute", f"{minute[:16]}:00.000000Z"),
+                        ("hour", f"{minute[:13]}:00:00.000000Z"),
+                    ]:
+                        self.conn.execute("""
+                            INSERT INTO buckets (event_type, resolution, bucket, count, sum) VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT (event_type, resolution, bucket)
+                            DO UPDATE SET count = count + excluded.count, sum = sum + excluded.sum
+                        """, (event_type, resolution, bucket, count, total))
+                days = {}
+                for (day, user_id), weights in window["users"].items():
+                    days.setdefault(day, {})[user_id] = weights
+                for day, users in days.items():
+                    self.add_top_users(event_type, day, users)
+            self.conn.execute("INSERT OR REPLACE INTO watermark (id, end_timestamp) VALUES (0, ?)", (end_timestamp,))
+        return True
+
+    def add_top_users(self, event_type, day, users):
+        """ Space-Saving update of one day's sketch: a new user past top_k replaces the smallest entry """
+        metric = 0 if TOP_USERS_METRIC[event_type] == "count" else 1
+        sketch = {
+            user_id: [count, total, error]
+            for user_id, count, total, error in self.conn.execute(
+                "SELECT user_id, count, sum, error FROM top_users WHERE event_type = ? AND day = ?", (event_type, day)
+            )
+        }
+        evicted = []
+        for user_id, (count, total) in sorted(users.items(), key=lambda item: -item[1][metric]):
+            if user_id in sketch:
+                sketch[user_id][0] += count
+                sketch[user_id][1] += total
+            elif len(sketch) < self.top_k:
+                sketch[user_id] = [count, total, 0]
+            else:
+                smallest = min(sketch, key=lambda u: sketch[u][metric])
+                smallest_count, smallest_total, _ = sketch.pop(smallest)
+                evicted.append(smallest)
+                sketch[user_id] = [
+                    smallest_count + count,
+                    smallest_total + total,
+                    smallest_count if metric == 0 else smallest_total
+                ]
+        self.conn.executemany(
+            "DELETE FROM top_users WHERE event_type = ? AND day = ? AND user_id = ?",
+            [(event_type, day, user_id) for user_id in evicted]
+        )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO top_users (event_type, day, user_id, count, sum, error) VALUES (?, ?, ?, ?, ?, ?)",
+            [(event_type, day, user_id, *values) for user_id, values in sketch.items()]
+        )
+
+    def prune(self, now):
+        """ Drops buckets and sketches older than their retention """
+        with self.lock, self.conn:
+            for resolution in ["minute", "hour"]:
+                cutoff = (now - timedelta(days=ROLLUPS_RETENTION_DAYS[resolution])).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+                self.conn.execute("DELETE FROM buckets WHERE resolution = ? AND bucket < ?", (resolution, cutoff))
+            cutoff = (now - timedelta(days=ROLLUPS_RETENTION_DAYS["top_users"])).strftime("%Y-%m-%d")
+            self.conn.execute("DELETE FROM top_users WHERE day < ?", (cutoff,))
+
+    def series(self, event_type, resolution, start, end):
+        """ Returns: buckets of an event type starting in [start, end) """
+        with self.lock:
+            return [
+                {"bucket": bucket, "count": count, "sum": total}
+                for bucket, count, total in self.conn.execute("""
+                    SELECT bucket, count, sum FROM buckets
+                    WHERE event_type = ? AND resolution = ? AND bucket >= ? AND bucket < ?
+                    ORDER BY bucket
+                """, (event_type, resolution, start, end))
+            ]
+
+    def top_users(self, event_type, start_day, end_day, limit):
+        """ Returns: heaviest users over the day sketches in [start_day, end_day], merged """
+        order = "count" if TOP_USERS_METRIC[event_type] == "count" else "sum"
+        with self.lock:
+            return [
+                {"user_id": user_id, "count": count, "sum": total, "error": error}
+                for user_id, count, total, error in self.conn.execute(f"""
+                    SELECT user_id, SUM(count) AS count, SUM(sum) AS sum, SUM(error) AS error FROM top_users
+                    WHERE event_type = ? AND day >= ? AND day <= ?
+                    GROUP BY user_id ORDER BY {order} DESC LIMIT ?
+                """, (event_type, start_day, end_day, limit))
+            ]
+
+rollups = Rollups(ROLLUPS_FILE, ROLLUPS_TOP_K) if ROLLUPS_ENABLED else None
+
+def new_rollup():
+    return {event: {"minutes": {}, "users": {}} for event in ["chat", "donation"]}
+
+def add_to_rollup(window, minute, day, user_id, count, total):
+    bucket = window["minutes"].setdefault(minute, [0, 0])
+    bucket[0] += count
+    bucket[1] += total
+    user = window["users"].setdefault((day, user_id), [0, 0])
+    user[0] += count
+    user[1] += total
+
+class KafkaWrapper:
+    """ Kafka wrapper for consumer """
+    def __init__(self, hostname, topic, consumer_group, consumer_timeout_ms=-1):
+        self.hostname = hostname
+        self.topic = topic
+        self.consumer_group = consumer_group
+        self.consumer_timeout_ms = consumer_timeout_ms
+        self.client = None
+        self.consumer = None
+        self.connect()
+
+    def connect(self):
+        """Infinite loop: will keep trying"""
+        while True:
+            logger.debug("Trying to connect to Kafka...")
+            if self.make_client():
+                if self.make_consumer():
+                    break
+            # Sleeps for a random amount of time (0.5 to 1.5s)
+            time.sleep(random.randint(500, 1500) / 1000)
+
+    def make_client(self):
+        """
+        Runs once, makes a client and sets it on the instance.
+        Returns: True (success), False (failure)
+        """
+        if self.client is not None:
+            return True
+        try:
+            self.client = KafkaClient(hosts=self.hostname)
+            logger.info("Kafka client created!")
+            return True
+        except KafkaException as e:
+            msg = f"Kafka error when making client: {e}"
+            logger.warning(msg)
+            self.client = None
+            self.consumer = None
+            return False
+
+    def make_consumer(self):
+        """
+        Runs once, makes a consumer and sets it on the instance.
+        Returns: True (success), False (failure)
+        """
+        if self.consumer is not None:
+            return True
+        if self.client is None:
+            return False
+        try:
+            topic = self.client.topics[str.encode(self.topic)]
+            # Own consumer group, so stats resume from their committed offsets
+            self.consumer = topic.get_simple_consumer(
+                consumer_group=str.encode(self.consumer_group),
+                reset_offset_on_start=False,
+                auto_offset_reset=OffsetType.EARLIEST,
+                consumer_timeout_ms=self.consumer_timeout_ms
+            )
+            logger.info("Kafka consumer created")
+        except KafkaException as e:
+            msg = f"Make error when making consumer: {e}"
+            logger.warning(msg)
+            self.client = None
+            self.consumer = None
+            return False
+
+    def messages(self):
+        """
+        Generator method that catches exceptions in the consumer loop.
+        Yields None when no message arrived within consumer_timeout_ms.
+        """
+        if self.consumer is None:
+            self.connect()
+        while True:
+            try:
+                for msg in self.consumer:
+                    yield msg
+                yield None
+            except KafkaException as e:
+                msg = f"Kafka issue in consumer: {e}"
+                logger.warning(msg)
+                self.client = None
+                self.consumer = None
+                self.connect()
+
+class StatsStore:
+    """
+    Current stats, served from memory. Every update is snapshotted to a temp
+    file that is renamed over the data file, so the file is always whole.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        self.data = None
+        self.etag = None
+        self.offsets = {}
+        self.restore()
+
+    def restore(self):
+        """ Loads the snapshot, if it is valid """
+        try:
+            with open(self.filename, "r") as fd:
+                snapshot = json.load(fd)
+        except (OSError, ValueError):
+            logger.info("No valid stats snapshot found")
+            return
+        # Files from before snapshots were versioned hold the stats directly
+        if "version" not in snapshot:
+            snapshot = {"version": STATS_FORMAT_VERSION, "stats": snapshot}
+        if snapshot["version"] != STATS_FORMAT_VERSION or not STATS_KEYS <= snapshot["stats"].keys():
+            logger.warning(f"Ignoring stats snapshot with version {snapshot['version']}")
+            return
+        self.set(snapshot["stats"])
+        self.offsets = {int(partition_id): offset for partition_id, offset in snapshot.get("offsets", {}).items()}
+        logger.info(f"Restored stats last updated at {self.data.get('last_updated')}")
+
+    def set(self, data):
+        body = json.dumps(data, sort_keys=True)
+        with self.lock:
+            self.data = data
+            self.etag = f'"{hashlib.md5(body.encode("utf-8")).hexdigest()}"'
+
+    def get(self):
+        """ Returns: (copy of the stats or None, ETag) """
+        with self.lock:
+            return (dict(self.data) if self.data is not None else None), self.etag
+
+    def update(self, data, offsets=None):
+        """
+        Snapshots the new stats, then serves them.
+        offsets: next Kafka offset per partition the stats include, in kafka mode
+        """
+        snapshot = {"version": STATS_FORMAT_VERSION, "stats": data}
+        if offsets is not None:
+            snapshot["offsets"] = offsets
+            self.offsets = dict(offsets)
+        tmp_file = f"{self.filename}.tmp"
+        with open(tmp_file, "w") as fd:
+            json.dump(snapshot, fd, indent=4)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_file, self.filename)
+        self.set(data)
+
+stats_store = StatsStore(DATA_FILE)
+
+# Stats runs never overlap, a run that finds one in progress is skipped
+run_lock = Lock()
+scheduler_stats_lock = Lock()
+scheduler_stats = {
+    "mode": SCHEDULER_MODE,
+    "runs": 0,
+    "skipped_runs": 0,
+    "last_run_ms": 0,
+    "max_run_ms": 0,
+    "interval_s": SCHEDULER_INTERVAL,
+}
+
+kafka_wrapper = KafkaWrapper(
+    f"{KAFKA_HOST}:{KAFKA_PORT}", KAFKA_TOPIC, KAFKA_CONSUMER_GROUP, KAFKA_CONSUMER_TIMEOUT_MS
+) if STATS_MODE == "kafka" else None
+
 def get_stats():
     logger.info("Request for stats received")
 
-    try:
-        with open(DATA_FILE, "r") as fd:
-            data = json.load(fd)
-            logger.debug(data)
-            logger.info("Request for stats completed")
-    except:
-        logger.error("Failed to get statistics, stats data file does not exist yet")
+    data, etag = stats_store.get()
+    if data is None:
+        logger.error("Failed to get statistics, stats have not been processed yet")
         return "Statistics do not exist", 404
-    
-    return data, 200
+
+    if request.headers.get("If-None-Match") == etag:
+        logger.info("Request for stats completed, not modified")
+        return NoContent, 304, {"ETag": etag}
+
+    logger.debug(data)
+    logger.info("Request for stats completed")
+    return data, 200, {"ETag": etag}
+
+def normalize_timestamp(timestamp):
+    """ Formats a date-time as the UTC strings buckets are stored with, so they compare in order """
+    return dt.fromisoformat(timestamp.replace("Z", "+00:00")).astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+def get_rollup_series(event_type, start_timestamp, end_timestamp, resolution="minute"):
+    logger.info(f"Request for {resolution} {event_type} rollups received")
+    if rollups is None:
+        return {"message": "Rollups are disabled"}, 404
+    return rollups.series(event_type, resolution, normalize_timestamp(start_timestamp), normalize_timestamp(end_timestamp)), 200
+
+def get_top_users(event_type, start_timestamp, end_timestamp, limit=10):
+    logger.info(f"Request for top {event_type} users received")
+    if rollups is None:
+        return {"message": "Rollups are disabled"}, 404
+    # Sketches are kept per day, so the range is widened to whole days
+    start_day = normalize_timestamp(start_timestamp)[:10]
+    end_day = normalize_timestamp(end_timestamp)[:10]
+    return rollups.top_users(event_type, start_day, end_day, limit), 200
 
 def populate_stats():
+    """
+    Adds the events since the last update to the stats, at most scheduler.max_window_s at a time.
+    If the window can't be read in full, nothing is saved and the next run retries it.
+    Returns: True (caught up, or the window failed), False (more events remain after this window)
+    """
     logger.info("Processing started")
 
     # Load data
-    try:
-        with open(DATA_FILE, "r") as fd:
-            data = json.load(fd)
-    except:
+    data, _ = stats_store.get()
+    if data is None:
         data = {
             "num_chats": 0,
             "total_chat_reactions": 0,
@@ -58,16 +439,94 @@ def populate_stats():
     # Query data and process
     default_timestamp = f"{dt.now().year}-01-01T00:00:00.000Z"
     start_timestamp = data.get("last_updated") or default_timestamp
-    end_timestamp = dt.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    now = dt.now(timezone.utc)
+    window_end = dt.fromisoformat(normalize_timestamp(start_timestamp).replace("Z", "+00:00")) + timedelta(seconds=SCHEDULER_MAX_WINDOW_S)
+    caught_up = window_end >= now
+    end_timestamp = (now if caught_up else window_end).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    # Aggregate in storage, or fall back to streaming the rows
+    rollup = new_rollup() if rollups is not None else None
+    if STATS_MODE != "aggregate" or not add_aggregates(data, start_timestamp, end_timestamp, rollup):
+        if rollup is not None:
+            rollup = new_rollup()
+        if not add_streamed_events(data, start_timestamp, end_timestamp, rollup):
+            # data is a copy, so the partial window is dropped and last_updated stays
+            logger.error(f"Processing failed, window from {start_timestamp} is retried next run")
+            return True
+
+    logger.debug(data)
+
+    if rollup is not None:
+        rollups.add_window(end_timestamp, rollup)
+        rollups.prune(dt.now(timezone.utc))
+    
+    # Update last_updated and write data
+    data["last_updated"] = end_timestamp
+    stats_store.update(data)
 
-    # Request chat events
+    logger.info(f"Processing ended | window_end={end_timestamp} | caught_up={caught_up}")
+    return caught_up
+
+def add_aggregates(data, start_timestamp, end_timestamp, rollup=None):
+    """
+    Adds the storage-side aggregates of a window to the stats,
+    and its per-minute and per-user rollups if rollup is given.
+    Returns: True (success), False (failure)
+    """
+    params = {"start_timestamp": start_timestamp, "end_timestamp": end_timestamp}
+    if rollup is not None:
+        params["rollup"] = "true"
+    try:
+        response = httpx.get(app_config['eventstores']['aggregate']['url'], params=params)
+    except httpx.HTTPError as e:
+        logger.error(f"Request for event aggregates failed: {e}")
+        return False
+    if response.status_code != 200:
+        logger.error(f"Request for event aggregates failed: {response.status_code}")
+        return False
+    aggregates = json.loads(response.content.decode("utf-8"))
+    logger.info(f"Received aggregates of {aggregates['chat']['count']} chat and {aggregates['donation']['count']} donation events")
+
+    data["num_chats"] += aggregates["chat"]["count"]
+    data["total_chat_reactions"] += int(aggregates["chat"]["sum"])
+    data["num_donations"] += aggregates["donation"]["count"]
+    data["total_donations"] += aggregates["donation"]["sum"]
+
+    if rollup is not None:
+        for event in ["chat", "donation"]:
+            for bucket in aggregates[event]["minutes"]:
+                rollup[event]["minutes"][bucket["minute"]] = [bucket["count"], bucket["sum"]]
+            for user in aggregates[event]["users"]:
+                rollup[event]["users"][(user["day"], user["user_id"])] = [user["count"], user["sum"]]
+    return True
+
+def add_streamed_events(data, start_timestamp, end_timestamp, rollup=None):
+    """
+    Adds the events of a window to the stats, following cursors page by page,
+    and to the per-minute and per-user rollups if rollup is given.
+    Returns: True (success), False (a page failed, so data and rollup are partial)
+    """
     for event in ["chat", "donation"]:
-        response = httpx.get(f"{app_config['eventstores'][event]['url']}?start_timestamp={start_timestamp}&end_timestamp={end_timestamp}")
-        if response.status_code != 200:
-            logger.error(f"Request for {event} events failed: {response.status_code}")
-        else:
+        cursor = None
+        num_events = 0
+        while True:
+            params = {
+                "start_timestamp": start_timestamp,
+                "end_timestamp": end_timestamp,
+                "limit": PAGE_SIZE,
+            }
+            if cursor is not None:
+                params["cursor"] = cursor
+            try:
+                response = httpx.get(app_config['eventstores'][event]['url'], params=params)
+            except httpx.HTTPError as e:
+                logger.error(f"Request for {event} events failed: {e}")
+                return False
+            if response.status_code != 200:
+                logger.error(f"Request for {event} events failed: {response.status_code}")
+                return False
             event_data = json.loads(response.content.decode("utf-8"))
-            logger.info(f"Received {len(event_data)} {event} events")
+            num_events += len(event_data)
 
             # Calculate stats
             if event == "chat":
@@ -78,21 +537,295 @@ def populate_stats():
                 data["num_donations"] += len(event_data)
                 for donation in event_data:
                     data["total_donations"] += donation.get("amount", 0)
+            if rollup is not None:
+                field = "reaction_count" if event == "chat" else "amount"
+                for row in event_data:
+                    add_to_rollup(rollup[event], row["timestamp"][:16], row["timestamp"][:10], row["user_id"], 1, row.get(field, 0))
 
-    logger.debug(data)
-    
-    # Update last_updated and write data
-    data["last_updated"] = end_timestamp
-    with open(app_config["datastore"]["filename"], "w") as fd:
-        json.dump(data, fd, indent=4)
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+        logger.info(f"Received {num_events} {event} events")
+    return True
 
-    logger.info("Processing ended")
+def consume_events():
+    """
+    Kafka mode: folds events into the stats as they arrive. Every flush_interval_s
+    the stats are snapshotted with the offsets they include, then the offsets are
+    committed. Events below the snapshot offsets were already counted, so they are
+    skipped if the commit was lost.
+    """
+    data, _ = stats_store.get()
+    if data is None:
+        data = {
+            "num_chats": 0,
+            "total_chat_reactions": 0,
+            "num_donations": 0,
+            "total_donations": 0.00,
+        }
+    offsets = dict(stats_store.offsets)
+    rollup = new_rollup() if rollups is not None else None
+    pending = 0
+    last_flush = time.time()
+
+    # This is blocking - it will wait for a new message
+    for msg in kafka_wrapper.messages():
+        if msg is not None and msg.offset >= offsets.get(msg.partition_id, 0):
+            KAFKA_CONSUMED.labels(KAFKA_TOPIC, "processing").inc()
+            # Read everything that can fail before folding, so a bad event changes nothing
+            try:
+                event = decode_message(msg.value)
+                event_type = event["type"]
+                payload = event["payload"]
+                field = {"chat": "reaction_count", "donation": "amount"}.get(event_type)
+                if field is not None:
+                    value = payload[field]
+                    user_id = payload["user_id"]
+                    timestamp = normalize_timestamp(payload["timestamp"])
+            except (KeyError, TypeError, ValueError) as e:
+                logger.error(f"Skipping malformed message at offset {msg.offset}: {e}")
+                event = None
+            if event is not None:
+                observe_event_age("processed", event)
+                if event_type == "chat":
+                    data["num_chats"] += 1
+                    data["total_chat_reactions"] += value
+                elif event_type == "donation":
+                    data["num_donations"] += 1
+                    data["total_donations"] += value
+                if rollup is not None and field is not None:
+                    add_to_rollup(rollup[event_type], timestamp[:16], timestamp[:10], user_id, 1, value)
+            offsets[msg.partition_id] = msg.offset + 1
+            pending += 1
+
+        if pending and time.time() - last_flush >= KAFKA_FLUSH_INTERVAL_S:
+            end_timestamp = dt.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+            if rollup is not None:
+                rollups.add_window(end_timestamp, rollup)
+                rollup = new_rollup()
+            data["last_updated"] = end_timestamp
+            stats_store.update(dict(data), offsets)
+            try:
+                kafka_wrapper.consumer.commit_offsets()
+            except (AttributeError, KafkaException) as e:
+                # The snapshot offsets still keep events from being counted twice
+                logger.warning(f"Kafka error when committing offsets: {e}")
+            logger.info(f"Folded {pending} events from Kafka | offsets={offsets}")
+            pending = 0
+            last_flush = time.time()
+
+def get_consumer_lag():
+    """ Messages left per partition, None if the broker can't be reached """
+    client, consumer = kafka_wrapper.client, kafka_wrapper.consumer
+    if client is None or consumer is None:
+        return None
+    try:
+        latest = client.topics[str.encode(KAFKA_TOPIC)].latest_available_offsets()
+        held = consumer.held_offsets
+    except KafkaException as e:
+        logger.warning(f"Could not get latest offsets: {e}")
+        return None
+    return {
+        partition_id: max(latest[partition_id].offset[0] - offset - 1, 0)
+        for partition_id, offset in held.items()
+        if partition_id in latest
+    }
+
+def init_kafka_thread():
+    t1 = Thread(target=consume_events)
+    t1.setDaemon(True)
+    t1.start()
+    start_lag_monitor(KAFKA_TOPIC, "processing", get_consumer_lag)
+
+def run_stats():
+    """
+    Runs populate_stats unless a run is already in progress.
+    Returns: result of populate_stats, None if the run was skipped
+    """
+    if not run_lock.acquire(blocking=False):
+        logger.warning("Previous stats run still in progress, skipping this one")
+        with scheduler_stats_lock:
+            scheduler_stats["skipped_runs"] += 1
+        return None
+    start_time = time.time()
+    try:
+        return populate_stats()
+    finally:
+        run_ms = int((time.time() - start_time) * 1000)
+        run_lock.release()
+        with scheduler_stats_lock:
+            scheduler_stats["runs"] += 1
+            scheduler_stats["last_run_ms"] = run_ms
+            scheduler_stats["max_run_ms"] = max(scheduler_stats["max_run_ms"], run_ms)
+
+def run_adaptive():
+    """
+    Runs stats back to back while a backlog remains, backs off while runs take
+    longer than the interval, and otherwise runs every scheduler.interval.
+    """
+    while True:
+        start_time = time.time()
+        try:
+            caught_up = run_stats()
+        except Exception as e:
+            logger.error(f"Stats run failed: {e}")
+            caught_up = True
+        duration = time.time() - start_time
+
+        if caught_up is False:
+            interval = SCHEDULER_MIN_INTERVAL
+        elif duration > SCHEDULER_INTERVAL:
+            interval = min(duration * 2, SCHEDULER_MAX_INTERVAL)
+        else:
+            interval = SCHEDULER_INTERVAL
+        with scheduler_stats_lock:
+            scheduler_stats["interval_s"] = interval
+        time.sleep(interval)
 
 def init_scheduler():
+    if SCHEDULER_MODE == "adaptive":
+        t1 = Thread(target=run_adaptive)
+        t1.setDaemon(True)
+        t1.start()
+        return
     sched = BackgroundScheduler(daemon=True)
-    sched.add_job(populate_stats, 'interval', seconds=app_config['scheduler']['interval'])
+    sched.add_job(run_stats, 'interval', seconds=SCHEDULER_INTERVAL, max_instances=1, coalesce=True)
     sched.start()
 
+def get_scheduler_stats():
+    logger.info("Request for scheduler stats received")
+    with scheduler_stats_lock:
+        stats = dict(scheduler_stats)
+    data, _ = stats_store.get()
+    if data is not None and data.get("last_updated"):
+        last_updated = dt.fromisoformat(normalize_timestamp(data["last_updated"]).replace("Z", "+00:00"))
+        stats["lag_s"] = round((dt.now(timezone.utc) - last_updated).total_seconds(), 3)
+    return stats
+
+class DashboardSnapshot:
+    """
+    Everything the dashboard shows, refreshed once per refresh_interval_s
+    however many viewers there are. Each refresh bumps the version.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.data = None
+        self.version = 0
+        self.etag = None
+
+    def fetch(self, url, params=None):
+        try:
+            response = httpx.get(url, params=params, timeout=DASHBOARD_REFRESH_INTERVAL_S)
+        except httpx.HTTPError as e:
+            logger.warning(f"Dashboard request for {url} failed: {e}")
+            return None
+        if response.status_code != 200:
+            logger.warning(f"Dashboard request for {url} failed: {response.status_code}")
+            return None
+        return response.json()
+
+    def refresh(self):
+        stats, _ = stats_store.get()
+        data = {
+            "updated_at": dt.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            "processing": stats,
+            "analyzer": self.fetch(f"{DASHBOARD_ANALYZER_URL}/stats"),
+            "chat": self.fetch(f"{DASHBOARD_ANALYZER_URL}/stream/chats", {"index": random.randint(0, 9)}),
+            "donation": self.fetch(f"{DASHBOARD_ANALYZER_URL}/stream/donations", {"index": random.randint(0, 9)}),
+            "check": self.fetch(DASHBOARD_CHECK_URL),
+        }
+        body = json.dumps(data, sort_keys=True)
+        with self.lock:
+            self.data = data
+            self.version += 1
+            self.etag = f'"{hashlib.md5(body.encode("utf-8")).hexdigest()}"'
+
+    def get(self):
+        """ Returns: (snapshot or None, version, ETag) """
+        with self.lock:
+            return self.data, self.version, self.etag
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Dashboard refresh failed: {e}")
+            time.sleep(DASHBOARD_REFRESH_INTERVAL_S)
+
+    def start(self):
+        t1 = Thread(target=self.run)
+        t1.setDaemon(True)
+        t1.start()
+
+dashboard = DashboardSnapshot()
+
+def get_dashboard():
+    logger.info("Request for dashboard snapshot received")
+    data, _, etag = dashboard.get()
+    if data is None:
+        return {"message": "Dashboard snapshot is not available yet"}, 404
+    if request.headers.get("If-None-Match") == etag:
+        return NoContent, 304, {"ETag": etag}
+    return data, 200, {"ETag": etag, "Cache-Control": f"max-age={DASHBOARD_REFRESH_INTERVAL_S}"}
+
+class DashboardStream:
+    """
+    ASGI middleware serving the dashboard as server-sent events. It runs outside
+    Flask, so each viewer is an asyncio task rather than a worker thread. The
+    first event is the whole snapshot, later ones only the sections that changed.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != DASHBOARD_STREAM_PATH:
+            await self.app(scope, receive, send)
+            return
+
+        disconnected = asyncio.Event()
+        async def wait_for_disconnect():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            disconnected.set()
+        watcher = asyncio.create_task(wait_for_disconnect())
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        sent = {}
+        sent_version = None
+        last_send = time.time()
+        try:
+            while not disconnected.is_set():
+                data, version, _ = dashboard.get()
+                if data is not None and version != sent_version:
+                    if sent:
+                        event, changed = "delta", {key: value for key, value in data.items() if sent.get(key) != value}
+                    else:
+                        event, changed = "snapshot", data
+                    body = f"event: {event}\ndata: {json.dumps(changed)}\n\n"
+                    await send({"type": "http.response.body", "body": body.encode("utf-8"), "more_body": True})
+                    sent, sent_version, last_send = data, version, time.time()
+                elif time.time() - last_send >= DASHBOARD_HEARTBEAT_S:
+                    # Comment line, keeps proxies from closing an idle stream
+                    await send({"type": "http.response.body", "body": b": ping\n\n", "more_body": True})
+                    last_send = time.time()
+                try:
+                    await asyncio.wait_for(disconnected.wait(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    pass
+        except OSError:
+            pass
+        finally:
+            watcher.cancel()
+
 app = connexion.FlaskApp(__name__, specification_dir='')
 app.add_api("stats.yaml", base_path="/processing", strict_validation=True, validate_responses=True)
 
@@ -106,6 +839,22 @@ if "CORS_ALLOW_ALL" in os.environ and os.environ["CORS_ALLOW_ALL"] == "yes":
         allow_headers=["*"],
     )
 
+if DASHBOARD_ENABLED:
+    app.add_middleware(DashboardStream, position=MiddlewarePosition.BEFORE_EXCEPTION)
+
+app.add_middleware(
+    MetricsMiddleware,
+    position=MiddlewarePosition.BEFORE_EXCEPTION,
+    spec_file="stats.yaml",
+    base_path="/processing",
+    extra_paths=[DASHBOARD_STREAM_PATH],
+)
+
 if __name__ == "__main__":
-    init_scheduler()
+    if DASHBOARD_ENABLED:
+        dashboard.start()
+    if STATS_MODE == "kafka":
+        init_kafka_thread()
+    else:
+        init_scheduler()
     app.run(port=8100, host="0.0.0.0")
\ No newline at end of file
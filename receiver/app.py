@@ -6,9 +6,19 @@ import yaml
 import time
 import random
 import json
-from datetime import datetime as dt
+import atexit
+import queue
+import zlib
+from threading import Lock
+from datetime import datetime as dt, timezone
 from pykafka import KafkaClient
-from pykafka.exceptions import KafkaException
+from pykafka.common import CompressionType
+from pykafka.partitioners import HashingPartitioner
+from pykafka.exceptions import KafkaException, ProducerQueueFullError
+from jsonschema import Draft4Validator
+from common.codec import encode_message, get_codec
+from common.metrics import KAFKA_PRODUCED, KAFKA_PRODUCE_LATENCY, MetricsMiddleware
+from connexion.middleware import MiddlewarePosition
 import os
 
 # Get environment
@@ -22,6 +32,24 @@ KAFKA_HOST = app_config["kafka"]["events"]["hostname"]
 KAFKA_PORT = app_config["kafka"]["events"]["port"]
 KAFKA_TOPIC = app_config["kafka"]["events"]["topic"]
 
+PRODUCER_MODE = app_config.get("producer", {}).get("mode", "sync")
+PRODUCER_LINGER_MS = app_config.get("producer", {}).get("linger_ms", 50)
+PRODUCER_BATCH_SIZE = app_config.get("producer", {}).get("batch_size", 100)
+PRODUCER_MAX_QUEUED = app_config.get("producer", {}).get("max_queued_messages", 10000)
+PRODUCER_COMPRESSION = app_config.get("producer", {}).get("compression", "none")
+PRODUCER_BATCH_TIMEOUT_S = app_config.get("producer", {}).get("batch_timeout_s", 10)
+PRODUCER_PARTITION_KEY = app_config.get("producer", {}).get("partition_key", "none")
+
+MESSAGE_CODEC = get_codec(app_config.get("codec", {}).get("format", "json"))
+
+# Per-item validators for batch ingestion, built from the API spec
+with open("livestream.yaml", "r") as f:
+    SCHEMAS = yaml.safe_load(f.read())["components"]["schemas"]
+EVENT_VALIDATORS = {
+    "chat": Draft4Validator(SCHEMAS["Chat"], format_checker=Draft4Validator.FORMAT_CHECKER),
+    "donation": Draft4Validator(SCHEMAS["Donation"], format_checker=Draft4Validator.FORMAT_CHECKER),
+}
+
 # Logging
 with open(f"config/log_conf.{ENVIRONMENT}.yml", "r") as f:
     LOG_CONFIG = yaml.safe_load(f.read())
@@ -29,6 +57,20 @@ with open(f"config/log_conf.{ENVIRONMENT}.yml", "r") as f:
 
 logger = logging.getLogger('basicLogger')
 
+producer_stats_lock = Lock()
+producer_stats = {
+    "mode": PRODUCER_MODE,
+    "produced": 0,
+    "delivered": 0,
+    "delivery_failures": 0,
+    "rejected": 0,
+}
+
+def on_delivery_failure(msg, exc):
+    """ Callback for messages the broker failed to acknowledge """
+    logger.error(f"Kafka delivery failed for message: {exc}")
+    logger.debug(msg.value)
+
 class KafkaWrapper:
     """ Kafka wrapper for producer """
     def __init__(self, hostname, topic):
@@ -36,6 +78,7 @@ class KafkaWrapper:
         self.topic = topic
         self.client = None
         self.producer = None
+        self.batch_producer = None
         self.connect()
 
     def connect(self):
@@ -66,6 +109,12 @@ class KafkaWrapper:
             self.producer = None
             return False
 
+    def partitioner_options(self):
+        """ Keyed messages go to the partition of the CRC32 of their key, the same in every receiver """
+        if PRODUCER_PARTITION_KEY == "none":
+            return {}
+        return {"partitioner": HashingPartitioner(hash_func=zlib.crc32)}
+
     def make_producer(self):
         """
         Runs once, makes a producer and sets it on the instance.
@@ -77,29 +126,150 @@ class KafkaWrapper:
             return False
         try:
             topic = self.client.topics[str.encode(self.topic)]
-            self.producer = topic.get_sync_producer()
-            logger.info("Kafka producer created")
+            if PRODUCER_MODE == "async":
+                self.producer = topic.get_producer(
+                    sync=False,
+                    linger_ms=PRODUCER_LINGER_MS,
+                    min_queued_messages=PRODUCER_BATCH_SIZE,
+                    max_queued_messages=PRODUCER_MAX_QUEUED,
+                    block_on_queue_full=False,
+                    compression=getattr(CompressionType, PRODUCER_COMPRESSION.upper()),
+                    delivery_reports=True,
+                    **self.partitioner_options()
+                )
+            else:
+                self.producer = topic.get_sync_producer(**self.partitioner_options())
+                # Batches are produced without waiting per message. Made here, before requests
+                # are served, so concurrent batches share one producer.
+                self.batch_producer = topic.get_producer(
+                    sync=False,
+                    linger_ms=0,
+                    max_queued_messages=PRODUCER_MAX_QUEUED,
+                    compression=getattr(CompressionType, PRODUCER_COMPRESSION.upper()),
+                    delivery_reports=True,
+                    **self.partitioner_options()
+                )
+            logger.info(f"Kafka producer created ({PRODUCER_MODE})")
         except KafkaException as e:
             msg = f"Make error when making producer: {e}"
             logger.warning(msg)
+            if self.producer is not None:
+                self.producer.stop()
             self.client = None
             self.producer = None
+            self.batch_producer = None
+            return False
+        return True
+
+    def produce(self, message, partition_key=None):
+        """
+        Produces a message. In async mode the message is only queued.
+        Returns: True (accepted), False (delivery queue is full)
+        """
+        start_time = time.perf_counter()
+        try:
+            self.producer.produce(message, partition_key=partition_key)
+        except ProducerQueueFullError:
+            logger.warning("Kafka delivery queue is full, rejecting message")
+            with producer_stats_lock:
+                producer_stats["rejected"] += 1
+            KAFKA_PRODUCED.labels(self.topic, "rejected").inc()
             return False
+        KAFKA_PRODUCE_LATENCY.labels(self.topic, PRODUCER_MODE).observe(time.perf_counter() - start_time)
+        with producer_stats_lock:
+            producer_stats["produced"] += 1
+            if PRODUCER_MODE == "sync":
+                producer_stats["delivered"] += 1
+        if PRODUCER_MODE == "sync":
+            KAFKA_PRODUCED.labels(self.topic, "delivered").inc()
+        if PRODUCER_MODE == "async":
+            self.check_delivery_reports()
+        return True
+
+    def produce_batch(self, messages, partition_keys):
+        """
+        Produces messages back to back so they share produce requests.
+        In sync mode, waits once for the whole batch to be acknowledged.
+        Returns: list with an error per message, None where it was accepted
+        """
+        if not messages:
+            return []
+        if PRODUCER_MODE == "async":
+            return [
+                None if self.produce(message, partition_key) else "Event queue is full"
+                for message, partition_key in zip(messages, partition_keys)
+            ]
+
+        start_time = time.perf_counter()
+        for message, partition_key in zip(messages, partition_keys):
+            self.batch_producer.produce(message, partition_key=partition_key)
+
+        # Each message carries its own trace id, so values are unique
+        errors = {message: "Delivery not confirmed" for message in messages}
+        deadline = time.monotonic() + PRODUCER_BATCH_TIMEOUT_S
+        pending = len(messages)
+        while pending > 0 and time.monotonic() < deadline:
+            try:
+                msg, exc = self.batch_producer.get_delivery_report(
+                    block=True, timeout=deadline - time.monotonic()
+                )
+            except queue.Empty:
+                break
+            if msg.value in errors:
+                pending -= 1
+                errors[msg.value] = None if exc is None else str(exc)
+                if exc is not None:
+                    on_delivery_failure(msg, exc)
+
+        results = [errors[message] for message in messages]
+        KAFKA_PRODUCE_LATENCY.labels(self.topic, "batch").observe(time.perf_counter() - start_time)
+        with producer_stats_lock:
+            producer_stats["produced"] += len(messages)
+            producer_stats["delivered"] += results.count(None)
+            producer_stats["delivery_failures"] += len(messages) - results.count(None)
+        KAFKA_PRODUCED.labels(self.topic, "delivered").inc(results.count(None))
+        KAFKA_PRODUCED.labels(self.topic, "failed").inc(len(messages) - results.count(None))
+        return results
+
+    def check_delivery_reports(self):
+        """
+        Drains the delivery reports of the calling thread.
+        pykafka keeps delivery reports per producing thread.
+        """
+        while True:
+            try:
+                msg, exc = self.producer.get_delivery_report(block=False)
+            except queue.Empty:
+                break
+            with producer_stats_lock:
+                if exc is None:
+                    producer_stats["delivered"] += 1
+                else:
+                    producer_stats["delivery_failures"] += 1
+            KAFKA_PRODUCED.labels(self.topic, "delivered" if exc is None else "failed").inc()
+            if exc is not None:
+                on_delivery_failure(msg, exc)
+
+    def close(self):
+        """ Flushes queued messages and stops the producer """
+        if self.producer is not None:
+            logger.info("Flushing Kafka producer")
+            self.producer.stop()
+            self.producer = None
+        if self.batch_producer is not None:
+            self.batch_producer.stop()
+            self.batch_producer = None
 
 kafka_wrapper = KafkaWrapper(f"{KAFKA_HOST}:{KAFKA_PORT}", KAFKA_TOPIC)
+atexit.register(kafka_wrapper.close)
 
 def post_chat(body):
     trace_id = str(uuid.uuid4())
     logger.info(f"Received event chat with a trace id of {trace_id}")
     body["trace_id"] = trace_id
 
-    msg = {
-        "type": "chat",
-        "datetime": dt.now().strftime("%Y-%m-%dT%H:%M:%S"),
-        "payload": body
-    }
-    msg_str = json.dumps(msg)
-    kafka_wrapper.producer.produce(msg_str.encode('utf-8'))
+    if not kafka_wrapper.produce(make_message("chat", body), make_partition_key(body)):
+        return {"message": "Event queue is full, try again later"}, 503
 
     return NoContent, 201
 
@@ -108,19 +278,106 @@ def post_donation(body):
     logger.info(f"Received event donation with a trace id of {trace_id}")
     body["trace_id"] = trace_id
 
+    if not kafka_wrapper.produce(make_message("donation", body), make_partition_key(body)):
+        return {"message": "Event queue is full, try again later"}, 503
+
+    return NoContent, 201
+
+def make_message(event_type, body):
+    """ Wraps an event payload in the Kafka message envelope """
     msg = {
-        "type": "donation",
-        "datetime": dt.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "type": event_type,
+        # UTC with milliseconds, consumers measure event age from it
+        "datetime": dt.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3],
         "payload": body
     }
-    msg_str = json.dumps(msg)
-    kafka_wrapper.producer.produce(msg_str.encode('utf-8'))
+    return encode_message(msg, MESSAGE_CODEC)
 
-    return NoContent, 201
+def make_partition_key(body):
+    """
+    Key of an event: events with the same key go to the same partition,
+    so they are consumed in order
+    """
+    if PRODUCER_PARTITION_KEY == "none":
+        return None
+    return body[PRODUCER_PARTITION_KEY].encode("utf-8")
+
+def parse_ndjson(body):
+    """ Parses newline delimited JSON, keeping unparseable lines as errors """
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    items = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError as e:
+            items.append(ValueError(f"Invalid JSON: {e}"))
+    return items
+
+def post_batch(body):
+    if isinstance(body, (bytes, str)):
+        items = parse_ndjson(body)
+    else:
+        items = body
+    logger.info(f"Received batch of {len(items)} events")
+
+    results = []
+    messages = []
+    partition_keys = []
+    for index, item in enumerate(items):
+        if isinstance(item, ValueError):
+            results.append({"index": index, "status": "rejected", "errors": [str(item)]})
+            continue
+        event_type = item.get("type") if isinstance(item, dict) else None
+        if event_type not in EVENT_VALIDATORS:
+            results.append({"index": index, "status": "rejected", "errors": [f"Invalid event type: {event_type}"]})
+            continue
+        payload = item.get("payload")
+        errors = [e.message for e in EVENT_VALIDATORS[event_type].iter_errors(payload)]
+        if errors:
+            results.append({"index": index, "status": "rejected", "errors": errors})
+            continue
+
+        trace_id = str(uuid.uuid4())
+        logger.info(f"Received event {event_type} with a trace id of {trace_id}")
+        payload["trace_id"] = trace_id
+        results.append({"index": index, "status": "accepted", "trace_id": trace_id})
+        messages.append(make_message(event_type, payload))
+        partition_keys.append(make_partition_key(payload))
+
+    # Produce every valid item together
+    accepted = [result for result in results if result["status"] == "accepted"]
+    for result, error in zip(accepted, kafka_wrapper.produce_batch(messages, partition_keys)):
+        if error is not None:
+            result["status"] = "rejected"
+            result["errors"] = [error]
+            del result["trace_id"]
+
+    num_accepted = sum(1 for result in results if result["status"] == "accepted")
+    logger.info(f"Batch processed | accepted={num_accepted} | rejected={len(results) - num_accepted}")
+    return {
+        "accepted": num_accepted,
+        "rejected": len(results) - num_accepted,
+        "results": results
+    }, 200
+
+def get_producer_stats():
+    logger.info("Received producer stats request")
+    with producer_stats_lock:
+        stats = dict(producer_stats)
+    return stats
 
 # Define all required functions
 app = connexion.FlaskApp(__name__, specification_dir='')
 app.add_api("livestream.yaml", base_path="/receiver", strict_validation=True, validate_responses=True)
+app.add_middleware(
+    MetricsMiddleware,
+    position=MiddlewarePosition.BEFORE_EXCEPTION,
+    spec_file="livestream.yaml",
+    base_path="/receiver",
+)
 
 if __name__ == "__main__":
     app.run(port=8080, host="0.0.0.0")
\ No newline at end of file
@@ -0,0 +1,97 @@
+"""
+Compares the cost per event of encoding, decoding and validating the Kafka
+envelope with each message codec.
+
+    python3 benchmark.py --events 100000
+
+"stdlib" is the json module the services used before codec.py, as a
+baseline. Validation is the request schema check the receiver runs on
+every event, and does not depend on the codec.
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+from datetime import datetime as dt, timedelta, timezone
+import yaml
+from jsonschema import Draft4Validator
+from common.codec import CODECS, decode_message, encode_message
+
+class StdlibJSONCodec:
+    """ The json module, as every service used it before codec.py """
+    def dumps(self, envelope):
+        return json.dumps(envelope).encode("utf-8")
+
+    def loads(self, data):
+        return json.loads(data.decode("utf-8"))
+
+def make_envelopes(num_events):
+    start = dt(2025, 1, 1, tzinfo=timezone.utc)
+    envelopes = []
+    for i in range(num_events):
+        payload = {
+            "event_id": str(uuid.uuid4()),
+            "trace_id": str(uuid.uuid4()),
+            "user_id": str(uuid.uuid4()),
+            "message": "Hello chat!",
+            "timestamp": (start + timedelta(milliseconds=i * 10)).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+        }
+        if random.random() < 0.8:
+            event_type = "chat"
+            payload["reaction_count"] = int(random.expovariate(0.1))
+        else:
+            event_type = "donation"
+            payload["amount"] = round(random.lognormvariate(2, 1), 2)
+            payload["currency"] = "CAD"
+        envelopes.append({"type": event_type, "datetime": "2025-01-01T00:00:00", "payload": payload})
+    return envelopes
+
+def time_per_event(func, items):
+    """ Returns: microseconds per item """
+    start_time = time.perf_counter()
+    for item in items:
+        func(item)
+    return (time.perf_counter() - start_time) / len(items) * 1000000
+
+def run_codec(name, envelopes):
+    if name == "stdlib":
+        stdlib = StdlibJSONCodec()
+        encode, decode = stdlib.dumps, stdlib.loads
+    else:
+        codec = CODECS[name]
+        encode, decode = lambda envelope: encode_message(envelope, codec), decode_message
+    messages = [encode(envelope) for envelope in envelopes]
+    assert decode(messages[0]) == envelopes[0]
+    return {
+        "encode_us": time_per_event(encode, envelopes),
+        "decode_us": time_per_event(decode, messages),
+        "bytes": sum(len(message) for message in messages) / len(messages),
+    }
+
+def run_validation(envelopes, spec_file):
+    with open(spec_file, "r") as f:
+        schemas = yaml.safe_load(f.read())["components"]["schemas"]
+    validators = {
+        "chat": Draft4Validator(schemas["Chat"], format_checker=Draft4Validator.FORMAT_CHECKER),
+        "donation": Draft4Validator(schemas["Donation"], format_checker=Draft4Validator.FORMAT_CHECKER),
+    }
+    return time_per_event(lambda envelope: validators[envelope["type"]].validate(envelope["payload"]), envelopes)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--spec", default="livestream.yaml")
+    args = parser.parse_args()
+
+    print(f"Generating {args.events} events...")
+    envelopes = make_envelopes(args.events)
+
+    print(f"{'codec':<10}{'encode_us':>12}{'decode_us':>12}{'bytes':>10}")
+    for name in ["stdlib"] + list(CODECS):
+        result = run_codec(name, envelopes)
+        print(f"{name:<10}{result['encode_us']:>12.2f}{result['decode_us']:>12.2f}{result['bytes']:>10.1f}")
+    print(f"validate_us={run_validation(envelopes, args.spec):.2f}")
+
+if __name__ == "__main__":
+    main()
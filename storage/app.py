@@ -2,17 +2,28 @@ import os
 import time
 import random
 import connexion
-from sqlalchemy import create_engine, select, func
+from sqlalchemy import create_engine, select, func, tuple_, cast
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.mysql import insert as mysql_insert, BIGINT
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from models import Base, Chat, Donation
-from datetime import datetime as dt
+from common.codec import decode_message
+from common.metrics import DB_LATENCY, KAFKA_CONSUMED, MetricsMiddleware, observe_event_age, setup_multiprocess, start_lag_monitor
+from common.offsets import next_offsets
+from connexion.middleware import MiddlewarePosition
+from datetime import datetime as dt, timezone
 import yaml
 import logging.config
 from pykafka import KafkaClient
 from pykafka.exceptions import KafkaException
 from pykafka.common import OffsetType
 import json
-from threading import Thread
+import base64
+import multiprocessing
+from flask import Response, stream_with_context
+from queue import Queue
+from collections import OrderedDict
+from threading import Thread, Lock
 
 # Get environment
 ENVIRONMENT = os.getenv('ENVIRONMENT')
@@ -31,6 +42,18 @@ KAFKA_HOST = app_config["kafka"]["events"]["hostname"]
 KAFKA_PORT = app_config["kafka"]["events"]["port"]
 KAFKA_TOPIC = app_config["kafka"]["events"]["topic"]
 
+PAGE_MAX_LIMIT = app_config.get("pagination", {}).get("max_limit", 5000)
+STREAM_CHUNK_SIZE = app_config.get("pagination", {}).get("stream_chunk_size", 1000)
+VALIDATE_RESPONSES = app_config.get("api", {}).get("validate_responses", True)
+
+CONSUMER_MODE = app_config.get("consumer", {}).get("mode", "single")
+CONSUMER_BATCH_SIZE = app_config.get("consumer", {}).get("batch_size", 500)
+CONSUMER_LINGER_MS = app_config.get("consumer", {}).get("linger_ms", 500)
+CONSUMER_MAX_IN_FLIGHT = app_config.get("consumer", {}).get("max_in_flight", 2)
+DEDUP_CACHE_SIZE = app_config.get("consumer", {}).get("dedup_cache_size", 100000)
+CONSUMER_WORKERS = app_config.get("consumer", {}).get("workers", 1)
+CONSUMER_WORKER_TYPE = app_config.get("consumer", {}).get("worker_type", "thread")
+
 # Logging
 with open(f"config/log_conf.{ENVIRONMENT}.yml", "r") as f:
     LOG_CONFIG = yaml.safe_load(f.read())
@@ -47,9 +70,11 @@ engine = create_engine(
 
 class KafkaWrapper:
     """ Kafka wrapper for consumer """
-    def __init__(self, hostname, topic):
+    def __init__(self, hostname, topic, consumer_timeout_ms=-1, balanced=False):
         self.hostname = hostname
         self.topic = topic
+        self.consumer_timeout_ms = consumer_timeout_ms
+        self.balanced = balanced
         self.client = None
         self.consumer = None
         self.connect()
@@ -93,11 +118,23 @@ class KafkaWrapper:
             return False
         try:
             topic = self.client.topics[str.encode(self.topic)]
-            self.consumer = topic.get_simple_consumer(
-                consumer_group=b'event_group',
-                reset_offset_on_start=False,
-                auto_offset_reset=OffsetType.LATEST
-            )
+            if self.balanced:
+                # Group membership through Kafka, each member gets a share of the partitions
+                self.consumer = topic.get_balanced_consumer(
+                    consumer_group=b'event_group',
+                    managed=True,
+                    auto_commit_enable=False,
+                    reset_offset_on_start=False,
+                    auto_offset_reset=OffsetType.LATEST,
+                    consumer_timeout_ms=self.consumer_timeout_ms
+                )
+            else:
+                self.consumer = topic.get_simple_consumer(
+                    consumer_group=b'event_group',
+                    reset_offset_on_start=False,
+                    auto_offset_reset=OffsetType.LATEST,
+                    consumer_timeout_ms=self.consumer_timeout_ms
+                )
             logger.info("Kafka consumer created")
         except KafkaException as e:
             msg = f"Make error when making consumer: {e}"
@@ -121,7 +158,100 @@ class KafkaWrapper:
                 self.consumer = None
                 self.connect()
 
-kafka_wrapper = KafkaWrapper(f"{KAFKA_HOST}:{KAFKA_PORT}", KAFKA_TOPIC)
+    def batches(self, batch_size, linger_ms):
+        """
+        Generator method that groups messages into batches. A batch is
+        yielded once it holds batch_size messages or its oldest message
+        has waited linger_ms, whichever comes first.
+        """
+        if self.consumer is None:
+            self.connect()
+        batch = []
+        deadline = None
+        while True:
+            try:
+                # Returns None once consumer_timeout_ms passes with no message
+                msg = self.consumer.consume(block=True)
+            except KafkaException as e:
+                msg = f"Kafka issue in consumer: {e}"
+                logger.warning(msg)
+                self.client = None
+                self.consumer = None
+                self.connect()
+                # Uncommitted messages are redelivered by the new consumer
+                batch = []
+                continue
+            if msg is not None:
+                if not batch:
+                    deadline = time.monotonic() + linger_ms / 1000
+                batch.append(msg)
+            if batch and (len(batch) >= batch_size or time.monotonic() >= deadline):
+                yield batch
+                batch = []
+
+# Batch mode workers make their own consumers
+kafka_wrapper = KafkaWrapper(f"{KAFKA_HOST}:{KAFKA_PORT}", KAFKA_TOPIC) if CONSUMER_MODE != "batch" else None
+
+def get_consumer_lag(wrapper):
+    """ Messages left per partition the consumer owns, None if the broker can't be reached """
+    client, consumer = wrapper.client, wrapper.consumer
+    if client is None or consumer is None:
+        return None
+    try:
+        latest = client.topics[str.encode(wrapper.topic)].latest_available_offsets()
+        held = consumer.held_offsets
+    except KafkaException as e:
+        logger.warning(f"Could not get latest offsets: {e}")
+        return None
+    return {
+        partition_id: max(latest[partition_id].offset[0] - offset - 1, 0)
+        for partition_id, offset in held.items()
+        if partition_id in latest
+    }
+
+class RecentIds:
+    """ Bounded LRU set of recently stored event IDs """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ids = OrderedDict()
+        self.lock = Lock()
+
+    def __contains__(self, event_id):
+        with self.lock:
+            if event_id in self.ids:
+                self.ids.move_to_end(event_id)
+                return True
+            return False
+
+    def add(self, event_id):
+        with self.lock:
+            self.ids[event_id] = None
+            self.ids.move_to_end(event_id)
+            while len(self.ids) > self.capacity:
+                self.ids.popitem(last=False)
+
+# Replays after a rebalance or reconnect are dropped here without a DB round trip
+recent_ids = RecentIds(DEDUP_CACHE_SIZE)
+
+# Stats from worker processes, set up by setup_kafka_thread
+stats_queue = None
+
+consumer_stats_lock = Lock()
+consumer_stats = {
+    "mode": CONSUMER_MODE,
+    "started_at": time.time(),
+    "messages_consumed": 0,
+    "chats_stored": 0,
+    "donations_stored": 0,
+    "batches_written": 0,
+    "offset_commits": 0,
+    "workers": CONSUMER_WORKERS if CONSUMER_MODE == "batch" else 1,
+    "batches_in_flight": 0,
+    "last_batch_size": 0,
+    "last_batch_ms": 0,
+    "duplicates_cache_hits": 0,
+    "duplicates_db_hits": 0,
+}
 
 def start_session():
     Base.metadata.bind = engine
@@ -130,29 +260,273 @@ def start_session():
 def process_messages():
     """ Process event messages """
     # This is blocking - it will wait for a new message
-    for msg in kafka_wrapper.messages():
-        msg_str = msg.value.decode('utf-8')
-        msg = json.loads(msg_str)
-        logger.info("Message: %s" % msg)
-        payload = msg["payload"]
-        if msg["type"] == "chat":
-            # Store the event1 (i.e., the payload) to the DB
-            post_chat(payload)
-        elif msg["type"] == "donation": # Change this to your event type
-        # Store the event2 (i.e., the payload) to the DB
-            post_donation(payload)
+    for message in kafka_wrapper.messages():
+        KAFKA_CONSUMED.labels(KAFKA_TOPIC, "storage").inc()
+        msg = None
+        stored = False
+        try:
+            msg = decode_message(message.value)
+            logger.info("Message: %s" % msg)
+            payload = msg["payload"]
+            if payload["event_id"] in recent_ids:
+                logger.debug(f"Skipped recently stored event with a trace id of {payload['trace_id']}")
+                with consumer_stats_lock:
+                    consumer_stats["duplicates_cache_hits"] += 1
+            elif msg["type"] == "chat":
+                # Store the event1 (i.e., the payload) to the DB
+                stored = post_chat(payload)
+            elif msg["type"] == "donation": # Change this to your event type
+            # Store the event2 (i.e., the payload) to the DB
+                stored = post_donation(payload)
+        except ValueError as e:
+            # Skipped, but still committed below so it is not read again
+            logger.error(f"Skipping malformed message at offset {message.offset}: {e}")
+        if stored:
+            observe_event_age("stored", msg)
 
         # Commit the new message as being read
         if kafka_wrapper.consumer is not None:
             kafka_wrapper.consumer.commit_offsets()
 
+        with consumer_stats_lock:
+            consumer_stats["messages_consumed"] += 1
+            consumer_stats["offset_commits"] += 1
+            if stored and msg["type"] == "chat":
+                consumer_stats["chats_stored"] += 1
+            elif stored and msg["type"] == "donation":
+                consumer_stats["donations_stored"] += 1
+
+class ConsumerWorker:
+    """
+    One member of the storage consumer group. It owns some partitions of the
+    topic and writes their batches through the shared DB pool. Events with
+    the same key share a partition, so each key is stored in order. If a
+    worker dies, the group hands its partitions to the others.
+    """
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.kafka_wrapper = None
+        # Batches consumed but not yet written, bounded by max_in_flight
+        self.batch_queue = Queue(maxsize=CONSUMER_MAX_IN_FLIGHT)
+
+    def consume_batches(self):
+        """ Groups event messages into batches and queues them for writing """
+        # This is blocking - it waits while max_in_flight batches are queued
+        for batch in self.kafka_wrapper.batches(CONSUMER_BATCH_SIZE, CONSUMER_LINGER_MS):
+            self.batch_queue.put(batch)
+            record_stats({"messages_consumed": len(batch), "batches_in_flight": 1})
+            KAFKA_CONSUMED.labels(KAFKA_TOPIC, f"storage-{self.worker_id}").inc(len(batch))
+
+    def write_batches(self):
+        """ Writes queued batches to the DB, then commits their offsets """
+        while True:
+            batch = self.batch_queue.get()
+            start_time = time.time()
+
+            chats = []
+            donations = []
+            envelopes = []
+            batch_ids = set()
+            cache_hits = 0
+            for msg in batch:
+                try:
+                    data = decode_message(msg.value)
+                except ValueError:
+                    logger.error(f"Skipping malformed message at offset {msg.offset}")
+                    continue
+                payload = data["payload"]
+                if payload["event_id"] in batch_ids or payload["event_id"] in recent_ids:
+                    cache_hits += 1
+                    continue
+                # A bad row is skipped, its offset is still committed with the batch
+                try:
+                    if data["type"] == "chat":
+                        chats.append(chat_row(payload))
+                    elif data["type"] == "donation":
+                        donations.append(donation_row(payload))
+                except ValueError as e:
+                    logger.error(f"Skipping event with a trace id of {payload['trace_id']} at offset {msg.offset}: {e}")
+                    continue
+                batch_ids.add(payload["event_id"])
+                envelopes.append(data)
+
+            # Keep retrying: offsets must not be committed before the batch is stored
+            while (stored := store_batch(chats, donations)) is None:
+                time.sleep(random.randint(500, 1500) / 1000)
+            num_chats, num_donations = stored
+            for event_id in batch_ids:
+                recent_ids.add(event_id)
+            for envelope in envelopes:
+                observe_event_age("stored", envelope)
+
+            # Commit only the offsets of this batch as being read. Partitions lost
+            # in a rebalance are skipped, their new owner replays them.
+            offsets = next_offsets(batch)
+            consumer = self.kafka_wrapper.consumer
+            if consumer is not None and consumer.partitions:
+                consumer.commit_offsets(partition_offsets=[
+                    (consumer.partitions[partition_id], offset)
+                    for partition_id, offset in offsets.items()
+                    if partition_id in consumer.partitions
+                ])
+
+            batch_ms = int((time.time() - start_time) * 1000)
+            duplicates = cache_hits + len(chats) + len(donations) - num_chats - num_donations
+            record_stats({
+                "chats_stored": num_chats,
+                "donations_stored": num_donations,
+                "duplicates_cache_hits": cache_hits,
+                "duplicates_db_hits": duplicates - cache_hits,
+                "batches_written": 1,
+                "offset_commits": 1,
+                "batches_in_flight": -1,
+            }, {"last_batch_size": len(batch), "last_batch_ms": batch_ms})
+            logger.debug(f"Worker {self.worker_id} stored batch of {num_chats} chats and {num_donations} donations | duplicates={duplicates} | processing_time_ms={batch_ms}")
+            self.batch_queue.task_done()
+
+    def start(self):
+        """ Connects, then consumes and writes on two threads """
+        self.kafka_wrapper = KafkaWrapper(
+            f"{KAFKA_HOST}:{KAFKA_PORT}",
+            KAFKA_TOPIC,
+            consumer_timeout_ms=CONSUMER_LINGER_MS,
+            balanced=True
+        )
+        start_lag_monitor(KAFKA_TOPIC, f"storage-{self.worker_id}", lambda: get_consumer_lag(self.kafka_wrapper))
+        logger.info(f"Storage consumer worker {self.worker_id} started")
+        for target in [self.consume_batches, self.write_batches]:
+            t1 = Thread(target=target)
+            t1.setDaemon(True)
+            t1.start()
+
+    def run_process(self):
+        """ Entry point of a worker process """
+        # Connections inherited from the parent must not be shared
+        engine.dispose(close=False)
+        self.start()
+        while True:
+            time.sleep(60)
+
+def record_stats(counts, last=None):
+    """
+    Adds counts to consumer_stats and sets the last_* values.
+    Worker processes send them to the parent instead.
+    """
+    if stats_queue is not None and multiprocessing.parent_process() is not None:
+        stats_queue.put((counts, last))
+        return
+    apply_stats(counts, last)
+
+def apply_stats(counts, last=None):
+    with consumer_stats_lock:
+        for key, value in counts.items():
+            consumer_stats[key] += value
+        consumer_stats.update(last or {})
+
+def collect_stats():
+    """ Applies the stats sent by worker processes """
+    while True:
+        apply_stats(*stats_queue.get())
+
+def insert_ignore_duplicates(model):
+    """ Insert that skips rows whose unique event_id is already stored """
+    statement = mysql_insert(model)
+    return statement.on_duplicate_key_update(event_id=statement.inserted.event_id)
+
+def new_rows(session, model, rows):
+    """ Drops rows whose event_id is already stored """
+    if not rows:
+        return rows
+    statement = select(model.event_id).where(model.event_id.in_([row["event_id"] for row in rows]))
+    existing = set(session.execute(statement).scalars())
+    return [row for row in rows if row["event_id"] not in existing]
+
+def store_batch(chats, donations):
+    """
+    Inserts a batch with one multi-row insert per event type in one transaction.
+    Events already stored (same event_id) are skipped.
+    Returns: (chats stored, donations stored), or None (failure)
+    """
+    session = start_session()
+    try:
+        start_time = time.perf_counter()
+        chats = new_rows(session, Chat, chats)
+        donations = new_rows(session, Donation, donations)
+        # The upsert still guards against a concurrent writer storing the same event
+        if chats:
+            session.execute(insert_ignore_duplicates(Chat), chats)
+        if donations:
+            session.execute(insert_ignore_duplicates(Donation), donations)
+        session.commit()
+        DB_LATENCY.labels("insert_batch").observe(time.perf_counter() - start_time)
+        return len(chats), len(donations)
+    except SQLAlchemyError as e:
+        logger.error(f"DB error when storing batch: {e}")
+        session.rollback()
+        return None
+    finally:
+        session.close()
+
+def parse_timestamp(timestamp):
+    """ Converts an ISO 8601 event timestamp to a naive UTC datetime """
+    value = dt.fromisoformat(timestamp.replace("Z", "+00:00"))
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def chat_row(body):
+    """ Column values of a chat event for a bulk insert """
+    return {
+        "event_id": body['event_id'],
+        "user_id": body['user_id'],
+        "message": body['message'],
+        "reaction_count": body['reaction_count'],
+        "timestamp": parse_timestamp(body['timestamp']),
+        "trace_id": body['trace_id'],
+    }
+
+def donation_row(body):
+    """ Column values of a donation event for a bulk insert """
+    return {
+        "event_id": body['event_id'],
+        "user_id": body['user_id'],
+        "amount": body['amount'],
+        "currency": body['currency'],
+        "message": body['message'],
+        "timestamp": parse_timestamp(body['timestamp']),
+        "trace_id": body['trace_id'],
+    }
+
 def setup_kafka_thread():
-    t1 = Thread(target=process_messages)
-    t1.setDaemon(True)
-    t1.start()
+    global stats_queue
+    if CONSUMER_MODE != "batch":
+        t1 = Thread(target=process_messages)
+        t1.setDaemon(True)
+        t1.start()
+        start_lag_monitor(KAFKA_TOPIC, "storage", lambda: get_consumer_lag(kafka_wrapper))
+        return
+
+    workers = [ConsumerWorker(worker_id) for worker_id in range(CONSUMER_WORKERS)]
+    if CONSUMER_WORKER_TYPE == "process":
+        # Workers count their metrics in PROMETHEUS_MULTIPROC_DIR, storage does not start without it
+        setup_multiprocess()
+        # Fork before any other thread starts
+        context = multiprocessing.get_context("fork")
+        stats_queue = context.Queue()
+        for worker in workers:
+            context.Process(target=worker.run_process, daemon=True).start()
+        t1 = Thread(target=collect_stats)
+        t1.setDaemon(True)
+        t1.start()
+    else:
+        for worker in workers:
+            worker.start()
 
 def post_chat(body):
-    """ Receives a chat """
+    """
+    Receives a chat
+    Returns: True (stored), False (already stored)
+    """
 
     session = start_session()
 
@@ -160,17 +534,32 @@ def post_chat(body):
                 body['user_id'],
                 body['message'],
                 body['reaction_count'],
-                body['timestamp'],
+                parse_timestamp(body['timestamp']),
                 body['trace_id'])
     session.add(chat)
-    
-    session.commit()
-    session.close()
 
+    try:
+        with DB_LATENCY.labels("insert").time():
+            session.commit()
+    except IntegrityError:
+        # event_id is unique, so a redelivered event is already stored
+        session.rollback()
+        logger.debug(f"Skipped duplicate event chat with a trace id of {body['trace_id']}")
+        with consumer_stats_lock:
+            consumer_stats["duplicates_db_hits"] += 1
+        return False
+    finally:
+        session.close()
+
+    recent_ids.add(body['event_id'])
     logger.debug(f"Stored event chat with a trace id of {body['trace_id']}")
+    return True
 
 def post_donation(body):
-    """ Receives a donation """
+    """
+    Receives a donation
+    Returns: True (stored), False (already stored)
+    """
 
     session = start_session()
 
@@ -179,75 +568,250 @@ def post_donation(body):
                 body['amount'],
                 body['currency'],
                 body['message'],
-                body['timestamp'],
+                parse_timestamp(body['timestamp']),
                 body['trace_id'])
     session.add(donation)
 
-    session.commit()
-    session.close()
-
+    try:
+        with DB_LATENCY.labels("insert").time():
+            session.commit()
+    except IntegrityError:
+        # event_id is unique, so a redelivered event is already stored
+        session.rollback()
+        logger.debug(f"Skipped duplicate event donation with a trace id of {body['trace_id']}")
+        with consumer_stats_lock:
+            consumer_stats["duplicates_db_hits"] += 1
+        return False
+    finally:
+        session.close()
+
+    recent_ids.add(body['event_id'])
     logger.debug(f"Stored event donation with a trace id of {body['trace_id']}")
+    return True
+
+def encode_cursor(date_created, id):
+    """ Opaque keyset cursor for the row after (date_created, id) """
+    value = f"{date_created.strftime('%Y-%m-%dT%H:%M:%S.%f')}|{id}"
+    return base64.urlsafe_b64encode(value.encode("utf-8")).decode("utf-8")
+
+def decode_cursor(cursor):
+    """ Returns: (date_created, id) of a keyset cursor """
+    value = base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8")
+    date_created, id = value.split("|")
+    return dt.strptime(date_created, "%Y-%m-%dT%H:%M:%S.%f"), int(id)
+
+def json_default(value):
+    """ Serializes datetimes like the connexion JSON encoder """
+    if isinstance(value, dt):
+        return value.isoformat() + ("" if value.tzinfo else "Z")
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def stream_rows(table, statement):
+    """ Yields rows as NDJSON, read through a server-side cursor """
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=STREAM_CHUNK_SIZE).execute(statement)
+        count = 0
+        for partition in result.mappings().partitions():
+            yield "".join(json.dumps(dict(row), default=json_default) + "\n" for row in partition)
+            count += len(partition)
+    logger.info("Streamed %d rows from %s", count, table.name)
+
+def get_events(model, start_timestamp, end_timestamp, limit, cursor, stream):
+    """
+    Gets the rows of a table in a time window, ordered by (date_created, id).
+    With limit, returns one page and sets X-Next-Cursor if more rows remain.
+    With stream, returns every row as chunked NDJSON.
+    """
+    table = model.__table__
+    start = parse_timestamp(start_timestamp)
+    end = parse_timestamp(end_timestamp)
+    statement = (
+        select(table)
+        .where(table.c.date_created >= start)
+        .where(table.c.date_created < end)
+        .order_by(table.c.date_created, table.c.id)
+    )
+    if cursor is not None:
+        try:
+            position = decode_cursor(cursor)
+        except ValueError:
+            return {"message": f"Invalid cursor: {cursor}"}, 400
+        statement = statement.where(tuple_(table.c.date_created, table.c.id) > position)
 
-def get_chats(start_timestamp, end_timestamp):
-    session = start_session()
-    start = dt.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-    end = dt.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-    statement = select(Chat).where(Chat.date_created >= start).where(Chat.date_created < end)
-    results = [
-        result.to_dict()
-        for result in session.execute(statement).scalars().all()
-    ]
-    session.close()
-    logger.info("Found %d chats (start: %s, end: %s)", len(results), start, end)
-    return results
+    if stream:
+        return Response(stream_with_context(stream_rows(table, statement)), mimetype="application/x-ndjson")
 
-def get_donations(start_timestamp, end_timestamp):
-    session = start_session()
-    start = dt.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-    end = dt.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
-    statement = select(Donation).where(Donation.date_created >= start).where(Donation.date_created < end)
-    results = [
-        result.to_dict()
-        for result in session.execute(statement).scalars().all()
-    ]
-    session.close()
-    logger.info("Found %d donations (start: %s, end: %s)", len(results), start, end)
-    return results
+    if limit is not None:
+        limit = min(limit, PAGE_MAX_LIMIT)
+        # One extra row tells whether there is a next page
+        statement = statement.limit(limit + 1)
+
+    with engine.connect() as conn:
+        results = [dict(row) for row in conn.execute(statement).mappings()]
+    logger.info("Found %d %s rows (start: %s, end: %s)", len(results), table.name, start, end)
+
+    headers = {}
+    if limit is not None and len(results) > limit:
+        results = results[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(results[-1]["date_created"], results[-1]["id"])
+    return results, 200, headers
+
+def get_chats(start_timestamp, end_timestamp, limit=None, cursor=None, stream=False):
+    return get_events(Chat, start_timestamp, end_timestamp, limit, cursor, stream)
+
+def get_donations(start_timestamp, end_timestamp, limit=None, cursor=None, stream=False):
+    return get_events(Donation, start_timestamp, end_timestamp, limit, cursor, stream)
 
 def get_count():
     logger.info("Received count request")
     session = start_session()
     chat_count = session.scalar(select(func.count()).select_from(Chat))
     donation_count = session.scalar(select(func.count()).select_from(Donation))
+    max_chat_id = session.scalar(select(func.max(Chat.id))) or 0
+    max_donation_id = session.scalar(select(func.max(Donation.id))) or 0
     session.close()
-    count = {"chat_count": chat_count, "donation_count": donation_count}
+    count = {
+        "chat_count": chat_count,
+        "donation_count": donation_count,
+        "max_chat_id": max_chat_id,
+        "max_donation_id": max_donation_id
+    }
     logger.info(count)
     return count
 
-def get_chat_event_ids():
-    logger.info("Received chat event IDs request")
+def get_aggregates(start_timestamp, end_timestamp, rollup=False):
+    """
+    Gets count/sum/min/max/avg per event type for a time window, computed in SQL.
+    With rollup, also gets count/sum per minute of event timestamp and per user per day.
+    """
     session = start_session()
-    statement = select(Chat)
-    results = [
-        result.to_event_ids()
-        for result in session.execute(statement).scalars().all()
-    ]
+    start = parse_timestamp(start_timestamp)
+    end = parse_timestamp(end_timestamp)
+    aggregates = {}
+    for event_type, model, column in [
+        ("chat", Chat, Chat.reaction_count),
+        ("donation", Donation, Donation.amount),
+    ]:
+        statement = (
+            select(func.count(), func.sum(column), func.min(column), func.max(column), func.avg(column))
+            .select_from(model)
+            .where(model.date_created >= start)
+            .where(model.date_created < end)
+        )
+        count, total, minimum, maximum, average = session.execute(statement).one()
+        aggregates[event_type] = {
+            "count": count,
+            "sum": float(total or 0),
+            "min": float(minimum or 0),
+            "max": float(maximum or 0),
+            "avg": float(average or 0),
+        }
+        if rollup:
+            window = (model.date_created >= start, model.date_created < end)
+            # Grouped by label, the format strings are bound parameters
+            minute = func.date_format(model.timestamp, "%Y-%m-%dT%H:%i").label("minute")
+            day = func.date_format(model.timestamp, "%Y-%m-%d").label("day")
+            aggregates[event_type]["minutes"] = [
+                {"minute": row_minute, "count": row_count, "sum": float(row_sum or 0)}
+                for row_minute, row_count, row_sum in session.execute(
+                    select(minute, func.count(), func.sum(column)).where(*window).group_by(minute)
+                )
+            ]
+            aggregates[event_type]["users"] = [
+                {"day": row_day, "user_id": user_id, "count": row_count, "sum": float(row_sum or 0)}
+                for row_day, user_id, row_count, row_sum in session.execute(
+                    select(day, model.user_id, func.count(), func.sum(column)).where(*window).group_by(day, model.user_id)
+                )
+            ]
+    session.close()
+    logger.info("Aggregated %d chats and %d donations (start: %s, end: %s)",
+                aggregates["chat"]["count"], aggregates["donation"]["count"], start, end)
+    return aggregates
+
+def get_consumer_stats():
+    logger.info("Received consumer stats request")
+    with consumer_stats_lock:
+        stats = dict(consumer_stats)
+    uptime = max(time.time() - stats.pop("started_at"), 1)
+    stats["events_per_sec"] = round((stats["chats_stored"] + stats["donations_stored"]) / uptime, 2)
+    return stats
+
+def id_bucket(model, buckets):
+    """ Bucket of each row: first 32 bits of MD5(event_id) modulo buckets """
+    return cast(func.conv(func.substring(func.md5(model.event_id), 1, 8), 16, 10), BIGINT(unsigned=True)) % buckets
+
+def id_hash(model):
+    """ Hash of each row: first 64 bits of MD5(event_id|trace_id) """
+    pair = func.concat(model.event_id, "|", model.trace_id)
+    return cast(func.conv(func.substring(func.md5(pair), 1, 16), 16, 10), BIGINT(unsigned=True))
+
+def get_event_ids(model, start_id, end_id, bucket=None, buckets=None, after_id=None):
+    """
+    Gets event ID and trace ID of each row, optionally in an event ID range or bucket.
+    With after_id, only rows with a greater row ID are returned, in row ID order and with their row ID.
+    """
+    if after_id is not None:
+        statement = (
+            select(model.event_id, model.trace_id, model.id)
+            .where(model.id > after_id)
+            .order_by(model.id)
+        )
+    else:
+        statement = select(model.event_id, model.trace_id)
+    if start_id is not None:
+        statement = statement.where(model.event_id >= start_id)
+    if end_id is not None:
+        statement = statement.where(model.event_id < end_id)
+    if bucket is not None and buckets is not None:
+        statement = statement.where(id_bucket(model, buckets) == bucket)
+    session = start_session()
+    results = [dict(row) for row in session.execute(statement).mappings()]
     session.close()
     return results
 
-def get_donation_event_ids():
+def get_chat_event_ids(start_id=None, end_id=None, bucket=None, buckets=None, after_id=None):
+    logger.info("Received chat event IDs request")
+    return get_event_ids(Chat, start_id, end_id, bucket, buckets, after_id)
+
+def get_donation_event_ids(start_id=None, end_id=None, bucket=None, buckets=None, after_id=None):
     logger.info("Received donation event IDs request")
+    return get_event_ids(Donation, start_id, end_id, bucket, buckets, after_id)
+
+def get_event_digest(model, buckets):
+    """
+    Gets the count and XOR of row hashes per event ID bucket, computed in SQL.
+    Only non-empty buckets are returned.
+    """
+    bucket = id_bucket(model, buckets).label("bucket")
+    statement = (
+        select(bucket, func.count(), func.bit_xor(id_hash(model)))
+        .group_by(bucket)
+        .order_by(bucket)
+    )
     session = start_session()
-    statement = select(Donation)
-    results = [
-        result.to_event_ids()
-        for result in session.execute(statement).scalars().all()
+    digests = [
+        {"bucket": int(bucket), "count": count, "digest": f"{int(digest):016x}"}
+        for bucket, count, digest in session.execute(statement)
     ]
     session.close()
-    return results
+    return {"buckets": buckets, "digests": digests}
+
+def get_chat_digest(buckets=256):
+    logger.info("Received chat digest request")
+    return get_event_digest(Chat, buckets)
+
+def get_donation_digest(buckets=256):
+    logger.info("Received donation digest request")
+    return get_event_digest(Donation, buckets)
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("livestream.yaml", base_path="/storage", strict_validation=True, validate_responses=True)
+app.add_api("livestream.yaml", base_path="/storage", strict_validation=True, validate_responses=VALIDATE_RESPONSES)
+app.add_middleware(
+    MetricsMiddleware,
+    position=MiddlewarePosition.BEFORE_EXCEPTION,
+    spec_file="livestream.yaml",
+    base_path="/storage",
+)
 
 if __name__ == "__main__":
     setup_kafka_thread()
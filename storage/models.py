@@ -1,5 +1,6 @@
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import Column, Integer, String, DateTime, Float
+from sqlalchemy import Column, Integer, String, DateTime, Float, Index
+from sqlalchemy.dialects import mysql
 from sqlalchemy.sql.functions import now
 
 class Base(DeclarativeBase):
@@ -10,15 +11,17 @@ class Chat(Base):
     """ Chat """
 
     __tablename__ = "chat"
+    # Named like the indexes of migration 002
+    __table_args__ = (Index("ux_chat_event_id", "event_id", unique=True),)
 
     id = Column(Integer, primary_key=True)
     event_id = Column(String(250), nullable=False)
-    user_id = Column(String(250), nullable=False)
+    user_id = Column(String(250), nullable=False, index=True)
     message = Column(String(1000), nullable=False)
     reaction_count = Column(Integer, nullable=False)
-    timestamp = Column(String(100), nullable=False)
-    date_created = Column(DateTime, nullable=False, default=now)
-    trace_id = Column(String(250), nullable=False)
+    timestamp = Column(mysql.DATETIME(fsp=3), nullable=False)
+    date_created = Column(DateTime, nullable=False, default=now, index=True)
+    trace_id = Column(String(250), nullable=False, index=True)
 
     def __init__(self, event_id, user_id, message, reaction_count, timestamp, trace_id):
         """ Initializes a chat message """
@@ -54,16 +57,18 @@ class Donation(Base):
     """ Donation """
 
     __tablename__ = "donation"
+    # Named like the indexes of migration 002
+    __table_args__ = (Index("ux_donation_event_id", "event_id", unique=True),)
 
     id = Column(Integer, primary_key=True)
     event_id = Column(String(250), nullable=False)
-    user_id = Column(String(250), nullable=False)
+    user_id = Column(String(250), nullable=False, index=True)
     amount = Column(Float, nullable=False)
     currency = Column(String(10), nullable=False)
     message = Column(String(1000), nullable=False)
-    timestamp = Column(String(100), nullable=False)
-    date_created = Column(DateTime, nullable=False, default=now)
-    trace_id = Column(String(250), nullable=False)
+    timestamp = Column(mysql.DATETIME(fsp=3), nullable=False)
+    date_created = Column(DateTime, nullable=False, default=now, index=True)
+    trace_id = Column(String(250), nullable=False, index=True)
 
     def __init__(self, event_id, user_id, amount, currency, message, timestamp, trace_id):
         """ Initializes a donation """
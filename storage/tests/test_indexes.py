@@ -0,0 +1,63 @@
+"""
+Checks that the storage queries are answered from the indexes of migration
+002, on the models' schema built in SQLite. data/explain_002_indexes.sql runs
+the same check against MySQL.
+"""
+from datetime import datetime as dt
+import pytest
+from sqlalchemy import create_engine, func, select, tuple_
+from models import Base, Chat, Donation
+
+START = dt(2025, 1, 1)
+END = dt(2025, 1, 2)
+
+@pytest.fixture(scope="module")
+def engine():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    return engine
+
+def query_plan(engine, statement):
+    compiled = statement.compile(engine, compile_kwargs={"literal_binds": True})
+    with engine.connect() as conn:
+        return " | ".join(row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}"))
+
+@pytest.mark.parametrize("model", [Chat, Donation])
+def test_keyset_page_uses_date_created_index(engine, model):
+    table = model.__table__
+    statement = (
+        select(table)
+        .where(table.c.date_created >= START)
+        .where(table.c.date_created < END)
+        .where(tuple_(table.c.date_created, table.c.id) > (START, 1000))
+        .order_by(table.c.date_created, table.c.id)
+        .limit(101)
+    )
+    plan = query_plan(engine, statement)
+    assert f"INDEX ix_{table.name}_date_created" in plan
+    # The index is already in (date_created, id) order
+    assert "TEMP B-TREE" not in plan
+
+@pytest.mark.parametrize("model, column", [(Chat, Chat.reaction_count), (Donation, Donation.amount)])
+def test_window_count_uses_date_created_index(engine, model, column):
+    statement = (
+        select(func.count(), func.sum(column))
+        .select_from(model)
+        .where(model.date_created >= START)
+        .where(model.date_created < END)
+    )
+    assert f"INDEX ix_{model.__tablename__}_date_created" in query_plan(engine, statement)
+
+@pytest.mark.parametrize("model", [Chat, Donation])
+def test_event_id_range_uses_unique_index(engine, model):
+    statement = (
+        select(model.event_id, model.trace_id)
+        .where(model.event_id >= "00000000")
+        .where(model.event_id < "80000000")
+    )
+    assert f"INDEX ux_{model.__tablename__}_event_id" in query_plan(engine, statement)
+
+@pytest.mark.parametrize("model, column", [(Chat, Chat.trace_id), (Chat, Chat.user_id), (Donation, Donation.trace_id), (Donation, Donation.user_id)])
+def test_lookups_use_their_index(engine, model, column):
+    statement = select(model.id).where(column == "d290f1ee-6c54-4b01-90e6-d701748f0851")
+    assert f"INDEX ix_{model.__tablename__}_{column.key}" in query_plan(engine, statement)